@@ -0,0 +1,278 @@
+# Benchmark de extremo a extremo sin red externa.
+#
+# Genera feeds RSS, páginas de artículos e imágenes de tamaño realista en un
+# directorio temporal, los sirve con un servidor HTTP local y recibe los correos
+# en un sumidero SMTP local (aiosmtpd). Ejecuta el ciclo de edición del bot
+# (planificar_ciclo, construir_ediciones, enviar_ediciones) con varios
+# suscriptores a varias escalas y registra el tiempo de cada etapa, el pico de
+# memoria (RSS) y el tamaño de los EPUB, comparando contra un baseline guardado.
+#
+# Uso:
+#   python benchmark.py                      # escalas 5, 50 y 500
+#   python benchmark.py --escalas 5,50
+#   python benchmark.py --guardar-baseline   # guarda los resultados como baseline
+#
+# Requiere aiosmtpd además de las dependencias del bot (pip install aiosmtpd).
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BASELINE_FILE = "bench_baseline.json"
+ITEMS_POR_FEED = 3
+DESTINATARIOS = 3
+# Vocabulario de pseudo-palabras de tres sílabas: con pocas palabras reales
+# todas las notas se parecerían y la detección de duplicadas las descartaría
+SILABAS = [c + v for c in "bcdfglmnprst" for v in "aeiou"]
+PALABRAS = random.Random(0).sample([a + b + c for a in SILABAS for b in SILABAS for c in SILABAS], 5000)
+ETAPAS = [
+    "importacion", "feeds", "seleccion", "ediciones", "smtp", "feeds_cache", "seleccion_cache", "ediciones_cache",
+]
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def frase(rnd, n):
+    return " ".join(rnd.choice(PALABRAS) for _ in range(n)).capitalize() + "."
+
+
+# --- Fixtures ---
+def generar_fixtures(directorio, escala, base_url, lado_imagen):
+    from PIL import Image
+
+    rnd = random.Random(escala)
+    for sub in ("feeds", "articulos", "imagenes"):
+        os.makedirs(os.path.join(directorio, sub), exist_ok=True)
+    fuentes = []
+    for f in range(escala):
+        items = []
+        for k in range(ITEMS_POR_FEED):
+            n = f * ITEMS_POR_FEED + k
+            titulo = f"Story {n}: " + frase(rnd, 8)
+            parrafos = "".join(f"<p>{frase(rnd, 40)} {frase(rnd, 30)}</p>" for _ in range(12))
+            # La mitad trae el artículo completo en content:encoded (extracción desde el feed)
+            contenido = ""
+            if n % 2 == 0:
+                contenido = (
+                    f'<content:encoded><![CDATA[<img src="{base_url}/imagenes/{n}.jpg">{parrafos}]]></content:encoded>'
+                )
+            with open(os.path.join(directorio, "articulos", f"{n}.html"), "w", encoding="utf-8") as fh:
+                fh.write(
+                    f"<html><head><title>{titulo}</title>"
+                    f'<meta property="og:image" content="{base_url}/imagenes/{n}.jpg"></head>'
+                    f"<body><article><h1>{titulo}</h1>{parrafos}</article></body></html>"
+                )
+            # Ruido gaussiano: pesa como una foto con mucho detalle, no como un color plano
+            im = Image.effect_noise((lado_imagen, lado_imagen * 2 // 3), 40).convert("RGB")
+            im.save(os.path.join(directorio, "imagenes", f"{n}.jpg"), quality=90)
+            items.append(
+                f"<item><title>{titulo}</title><link>{base_url}/articulos/{n}.html</link>"
+                f"<guid>{base_url}/articulos/{n}.html</guid><description>{frase(rnd, 25)}</description>"
+                f"{contenido}</item>"
+            )
+        with open(os.path.join(directorio, "feeds", f"{f}.xml"), "w", encoding="utf-8") as fh:
+            fh.write(
+                '<?xml version="1.0" encoding="utf-8"?>'
+                '<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/"><channel>'
+                f"<title>Fuente {f}</title>{''.join(items)}</channel></rss>"
+            )
+        fuentes.append({"name": f"Fuente{f}", "rss": f"{base_url}/feeds/{f}.xml"})
+    return fuentes
+
+
+# --- Ejecución de una escala (proceso hijo) ---
+def ejecutar_escala(escala, smtp_port):
+    from aiosmtpd.controller import Controller
+
+    class Sumidero:
+        mensajes = 0
+        bytes = 0
+
+        async def handle_DATA(self, server, session, envelope):
+            Sumidero.mensajes += 1
+            Sumidero.bytes += len(envelope.content)
+            return "250 OK"
+
+    sumidero = Controller(Sumidero(), hostname="127.0.0.1", port=smtp_port)
+    sumidero.start()
+    tiempos = {}
+
+    def medir(etapa, funcion, *args):
+        inicio = time.perf_counter()
+        resultado = funcion(*args)
+        tiempos[etapa] = round(time.perf_counter() - inicio, 3)
+        return resultado
+
+    inicio = time.perf_counter()
+    import bot_script as bot
+    tiempos["importacion"] = round(time.perf_counter() - inicio, 3)
+
+    # Suscriptores: lector0 con las fuentes generales (comparte edición con el
+    # propietario) y lector1 y lector2 con fuentes propias que se solapan
+    fuentes = bot.cargar_fuentes()
+    destinatarios = [f"lector{n}@example.com" for n in range(DESTINATARIOS)]
+    bot.guardar_emails(destinatarios)
+    bot.guardar_suscripciones({
+        destinatarios[1]: {"fuentes": fuentes[1::2]},
+        destinatarios[2]: {"fuentes": fuentes[::-1]},
+    })
+    bot.enviar_epub_a_destinatarios = functools.partial(
+        bot.enviar_epub_a_destinatarios, hostname="127.0.0.1", port=smtp_port, start_tls=False, username=None,
+    )
+
+    def etapa_bot(etapa, origen):
+        # Duración registrada por bot.medir dentro de planificar_ciclo
+        series = bot._metricas["raspinews_etapa_segundos"]["series"]
+        return round(series[(("etapa", etapa), ("origen", origen))]["ultimo"], 3)
+
+    ediciones = bot.planificar_ciclo("benchmark", escala)
+    tiempos["feeds"] = etapa_bot("feeds", "benchmark")
+    tiempos["seleccion"] = etapa_bot("seleccion", "benchmark")
+    medir("ediciones", bot.construir_ediciones, ediciones)
+    envios = medir("smtp", asyncio.run, bot.enviar_ediciones(ediciones, "edicion.epub"))
+    # Segunda pasada con las cachés calientes (GET condicional y ediciones ya construidas):
+    # sin registrar lo enviado, la selección es la misma
+    repetidas = bot.planificar_ciclo("benchmark_cache", escala)
+    tiempos["feeds_cache"] = etapa_bot("feeds", "benchmark_cache")
+    tiempos["seleccion_cache"] = etapa_bot("seleccion", "benchmark_cache")
+    medir("ediciones_cache", bot.construir_ediciones, repetidas)
+    sumidero.stop()
+    bot.cerrar_pool_imagenes()
+
+    propio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    hijos = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        "escala": escala,
+        "articulos": len(bot.urls_de(ediciones)),
+        "ediciones": len(ediciones),
+        "extraccion": {
+            dict(clave)["metodo"]: n for clave, n in bot._metricas["raspinews_extraccion_total"]["series"].items()
+        },
+        "tiempos": tiempos,
+        "rss_pico_mb": round(propio / 1024, 1),
+        "rss_pico_workers_mb": round(hijos / 1024, 1),
+        "epub_bytes": sum(os.path.getsize(e["ruta"]) for e in ediciones),
+        "emails_ok": sum(1 for error in envios.values() if error is None),
+        "smtp_bytes": Sumidero.bytes,
+    }
+
+
+def correr_escala(escala, lado_imagen):
+    from cryptography.fernet import Fernet
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory(prefix=f"bench{escala}_") as directorio:
+        http_port, smtp_port = puerto_libre(), puerto_libre()
+        base_url = f"http://127.0.0.1:{http_port}"
+        www = os.path.join(directorio, "www")
+        trabajo = os.path.join(directorio, "trabajo")
+        os.makedirs(trabajo)
+        print(f"[bench] Generando fixtures para escala {escala}...", flush=True)
+        fuentes = generar_fixtures(www, escala, base_url, lado_imagen)
+        with open(os.path.join(trabajo, "news_sources.json"), "w", encoding="utf-8") as fh:
+            json.dump(fuentes, fh)
+        servidor = subprocess.Popen(
+            [sys.executable, "-m", "http.server", str(http_port), "--bind", "127.0.0.1", "--directory", www],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            for _ in range(50):
+                try:
+                    socket.create_connection(("127.0.0.1", http_port), timeout=0.2).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            entorno = dict(
+                os.environ,
+                PYTHONPATH=repo,
+                TELEGRAM_TOKEN="0:benchmark",
+                TELEGRAM_USER_ID="0",
+                EMAIL_ENCRYPTION_KEY=Fernet.generate_key().decode(),
+                EMAIL_SENDER="bench@example.com",
+                EMAIL_PASSWORD="-",
+            )
+            proceso = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--hijo", str(escala), "--smtp-port", str(smtp_port)],
+                cwd=trabajo, env=entorno, capture_output=True, text=True,
+            )
+        finally:
+            servidor.terminate()
+            servidor.wait()
+    if proceso.returncode != 0:
+        raise RuntimeError(f"La escala {escala} falló:\n{proceso.stderr[-3000:]}")
+    return json.loads(proceso.stdout.strip().splitlines()[-1])
+
+
+# --- Comparación con el baseline ---
+def comparar(resultados, baseline, tolerancia):
+    regresiones = []
+    for r in resultados:
+        base = baseline.get(str(r["escala"]))
+        print(f"\n== Escala {r['escala']} ({r['articulos']} artículos en {r['ediciones']} ediciones)")
+        print("  extracción       " + ", ".join(f"{m}: {n}" for m, n in sorted(r["extraccion"].items())))
+        filas = [(etapa, r["tiempos"].get(etapa), (base or {}).get("tiempos", {}).get(etapa)) for etapa in ETAPAS]
+        filas += [
+            ("rss_pico_mb", r["rss_pico_mb"], (base or {}).get("rss_pico_mb")),
+            ("epub_bytes", r["epub_bytes"], (base or {}).get("epub_bytes")),
+        ]
+        for nombre, actual, previo in filas:
+            if actual is None:
+                continue
+            linea = f"  {nombre:<16} {actual:>12}"
+            if previo:
+                cambio = (actual - previo) / previo
+                linea += f"  baseline {previo:>12}  {cambio:+.1%}"
+                if cambio > tolerancia:
+                    linea += "  <-- regresión"
+                    regresiones.append((r["escala"], nombre))
+            print(linea)
+    return regresiones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del pipeline de RaspiNews")
+    parser.add_argument("--escalas", default="5,50,500")
+    parser.add_argument("--lado-imagen", type=int, default=1600, help="ancho en px de las imágenes de prueba")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--guardar-baseline", action="store_true")
+    parser.add_argument("--tolerancia", type=float, default=0.15, help="aumento relativo tolerado")
+    parser.add_argument("--hijo", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--smtp-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.hijo is not None:
+        resultado = ejecutar_escala(args.hijo, args.smtp_port)
+        sys.stdout.flush()
+        print(json.dumps(resultado))
+        return
+
+    resultados = [correr_escala(int(e), args.lado_imagen) for e in args.escalas.split(",")]
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as fh:
+            baseline = json.load(fh)
+    regresiones = comparar(resultados, baseline, args.tolerancia)
+    if args.guardar_baseline:
+        baseline.update({str(r["escala"]): r for r in resultados})
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(baseline, fh, indent=2)
+        print(f"\nBaseline guardado en {args.baseline}")
+    elif regresiones:
+        print(f"\n{len(regresiones)} regresiones respecto al baseline")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,73 @@
+import time
+_inicio_arranque = time.perf_counter()
 import os
+import sys
 import json
+import hashlib
+import importlib
+import sqlite3
 import tempfile
 import requests
-import feedparser
-from newspaper import Article
-from ebooklib import epub
-from bs4 import BeautifulSoup
-from PIL import Image
+from email import policy
 from email.message import EmailMessage
 from email.utils import formataddr
 from email_validator import validate_email, EmailNotValidError
-from cryptography.fernet import Fernet
 from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
 )
-from apscheduler.schedulers.background import BackgroundScheduler
+import array
 import asyncio
+import collections
+import contextlib
+import copy
+import functools
 import subprocess
 import io
-from datetime import datetime
+import re
+import unicodedata
+import zipfile
+import zlib
+import threading
+import multiprocessing
+from concurrent.futures import (
+    Future, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FuturesTimeout
+)
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urljoin, urlparse
+from html import escape
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Importaciones diferidas ---
+# newspaper (nltk, lxml), ebooklib, feedparser, PIL, cryptography y
+# APScheduler se cargan en el primer uso para que el bot responda enseguida
+# tras cada reinicio. tiempos_importacion registra cuánto costó cada una.
+tiempos_importacion = {}
+tiempos_arranque = {"imports": time.perf_counter() - _inicio_arranque, "listo": None}
+
+def modulo(nombre):
+    # import_module espera correctamente si otro hilo está importando el mismo módulo
+    if nombre in sys.modules:
+        return importlib.import_module(nombre)
+    inicio = time.perf_counter()
+    cargado = importlib.import_module(nombre)
+    tiempos_importacion.setdefault(nombre, time.perf_counter() - inicio)
+    return cargado
+
+def reporte_importaciones():
+    linea = f"Arranque: imports iniciales {tiempos_arranque['imports']:.2f}s"
+    if tiempos_arranque["listo"] is not None:
+        linea += f", listo en {tiempos_arranque['listo']:.2f}s"
+    lineas = [linea]
+    if tiempos_importacion:
+        lineas.append("Importaciones diferidas: " + ", ".join(
+            f"{k} {v:.2f}s" for k, v in sorted(tiempos_importacion.items(), key=lambda kv: -kv[1])
+        ))
+    else:
+        lineas.append("Importaciones diferidas: ninguna todavía")
+    return lineas
 
 # --- Configuración y utilidades ---
 load_dotenv()
@@ -32,183 +79,956 @@ EMAIL_SENDER = os.getenv("EMAIL_SENDER")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") != "0"
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))
+SMTP_RETRIES = int(os.getenv("SMTP_RETRIES", 3))
+SMTP_BACKOFF = float(os.getenv("SMTP_BACKOFF", 2))
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 60))
 
 EMAILS_FILE = "emails.enc"
 NEWS_SOURCES_FILE = "news_sources.json"
+SUBSCRIPTIONS_FILE = "subscriptions.enc"
 SENT_NEWS_FILE = "sent_news.json"
+SENT_NEWS_DB = "sent_news.db"
+ARCHIVE_DB = "archive.db"
+ARCHIVE_RETENTION_DAYS = float(os.getenv("ARCHIVE_RETENTION_DAYS", 365))
+SENT_NEWS_RETENTION_DAYS = float(os.getenv("SENT_NEWS_RETENTION_DAYS", 90))
+# Similitud de Jaccard a partir de la cual dos noticias se consideran la misma
+DUPLICATE_SIMILARITY = float(os.getenv("DUPLICATE_SIMILARITY", 0.5))
+DUPLICATE_DAYS = float(os.getenv("DUPLICATE_DAYS", 3))
+FEED_CACHE_FILE = "feed_cache.json"
+FEED_WORKERS = int(os.getenv("FEED_WORKERS", 8))
+FEED_TIMEOUT = float(os.getenv("FEED_TIMEOUT", 15))
+FEED_TIMEOUT_MIN = float(os.getenv("FEED_TIMEOUT_MIN", 3))
+SOURCE_HEALTH_FILE = "source_health.json"
+SOURCE_BREAKER_FAILURES = int(os.getenv("SOURCE_BREAKER_FAILURES", 3))
+SOURCE_BREAKER_MINUTES = float(os.getenv("SOURCE_BREAKER_MINUTES", 30))
+FEED_EARLY_STOP = os.getenv("FEED_EARLY_STOP", "1") != "0"
+ARTICLE_WORKERS = int(os.getenv("ARTICLE_WORKERS", 6))
+ARTICLE_PER_HOST = int(os.getenv("ARTICLE_PER_HOST", 2))
+ARTICLE_TIMEOUT = float(os.getenv("ARTICLE_TIMEOUT", 90))
+ARTICLE_REQUEST_TIMEOUT = float(os.getenv("ARTICLE_REQUEST_TIMEOUT", 15))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 4))
+FEED_MAX_BYTES = int(float(os.getenv("FEED_MAX_MB", 5)) * 1024 * 1024)
+ARTICLE_MAX_BYTES = int(float(os.getenv("ARTICLE_MAX_MB", 5)) * 1024 * 1024)
+IMAGE_MAX_BYTES = int(float(os.getenv("IMAGE_MAX_MB", 15)) * 1024 * 1024)
+# Texto mínimo para aceptar el contenido del feed o el extractor lxml
+EXTRACTION_MIN_CHARS = int(os.getenv("EXTRACTION_MIN_CHARS", 600))
+ARTICLE_CACHE_DIR = "article_cache"
+ARTICLE_CACHE_TTL = float(os.getenv("ARTICLE_CACHE_TTL_HOURS", 24)) * 3600
+ARTICLE_CACHE_MAX_BYTES = int(float(os.getenv("ARTICLE_CACHE_MAX_MB", 200)) * 1024 * 1024)
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1))
+IMAGE_TIMEOUT = float(os.getenv("IMAGE_TIMEOUT", 30))
+IMAGE_CACHE_DIR = "image_cache"
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL_HOURS", 72)) * 3600
+IMAGE_CACHE_MAX_BYTES = int(float(os.getenv("IMAGE_CACHE_MAX_MB", 100)) * 1024 * 1024)
+IMAGEN_MAX_LADO = 1200
+IMAGEN_CALIDAD = 85
+IMAGEN_CALIDAD_MIN = 35
+# Resoluciones que prueba el ajuste al presupuesto, de mayor a menor
+IMAGEN_LADOS_AJUSTE = (IMAGEN_MAX_LADO, 900, 600)
+# La búsqueda de calidad hace varias codificaciones por resolución
+IMAGEN_TIMEOUT_AJUSTE = IMAGE_TIMEOUT * len(IMAGEN_LADOS_AJUSTE)
+EPUB_MAX_BYTES = int(float(os.getenv("EPUB_MAX_MB", 15)) * 1024 * 1024)
+EPUB_STREAMING = os.getenv("EPUB_STREAMING", "1") != "0"
+EDITION_CACHE_DIR = "edition_cache"
+EDITION_CACHE_TTL = float(os.getenv("EDITION_CACHE_TTL_HOURS", 72)) * 3600
+EDITION_CACHE_MAX_BYTES = int(float(os.getenv("EDITION_CACHE_MAX_MB", 50)) * 1024 * 1024)
+# Subir al cambiar el formato del EPUB para no reutilizar ediciones viejas
+PLANTILLA_EPUB_VERSION = 2
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+NOTIFY_INTERVAL = float(os.getenv("NOTIFY_INTERVAL", 10))
+NOTIFY_MAX_CHARS = int(os.getenv("NOTIFY_MAX_CHARS", 500))
+EDITION_TIME = os.getenv("EDITION_TIME", "07:00")
+EDITION_MAX_ARTICLES = 10
+EDITION_WORKERS = int(os.getenv("EDITION_WORKERS", 2))
+PREFETCH_MINUTES = float(os.getenv("PREFETCH_MINUTES", 60))
+PREFETCH_ARTICLES = int(os.getenv("PREFETCH_ARTICLES", 2 * EDITION_MAX_ARTICLES))
 
 if not all([TELEGRAM_TOKEN, CHAT_ID, EMAIL_ENCRYPTION_KEY, EMAIL_SENDER, EMAIL_PASSWORD]):
     raise Exception("Faltan variables de entorno requeridas en .env")
 
-fernet = Fernet(EMAIL_ENCRYPTION_KEY.encode())
+_fernet = None
 
-# --- Emails cifrados ---
-import asyncio
+def obtener_fernet():
+    global _fernet
+    if _fernet is None:
+        _fernet = modulo("cryptography.fernet").Fernet(EMAIL_ENCRYPTION_KEY.encode())
+    return _fernet
+
+# --- Notificaciones al propietario ---
+# Cola en memoria: notificar() sólo encola (sirve desde cualquier hilo) y
+# despachar_notificaciones() envía lotes agrupados cada NOTIFY_INTERVAL segundos
+# con el bot de la aplicación.
+TELEGRAM_MAX_CHARS = 4096
+_notificaciones = collections.deque(maxlen=200)
+
+def notificar(texto):
+    if len(texto) > NOTIFY_MAX_CHARS:
+        texto = texto[:NOTIFY_MAX_CHARS] + f"… (+{len(texto) - NOTIFY_MAX_CHARS} caracteres)"
+    _notificaciones.append(texto)
+
+def agrupar_notificaciones(mensajes):
+    # Une mensajes repetidos y los reparte en bloques que caben en un mensaje de Telegram
+    conteo = collections.Counter(mensajes)
+    lineas = [m if conteo[m] == 1 else f"{m} (x{conteo[m]})" for m in dict.fromkeys(mensajes)]
+    bloques, actual = [], ""
+    for linea in lineas:
+        linea = linea[:TELEGRAM_MAX_CHARS]
+        if actual and len(actual) + 1 + len(linea) > TELEGRAM_MAX_CHARS:
+            bloques.append(actual)
+            actual = ""
+        actual = f"{actual}\n{linea}" if actual else linea
+    if actual:
+        bloques.append(actual)
+    return bloques
+
+async def despachar_notificaciones(application):
+    while True:
+        await asyncio.sleep(NOTIFY_INTERVAL)
+        mensajes = []
+        while _notificaciones:
+            mensajes.append(_notificaciones.popleft())
+        for n, bloque in enumerate(agrupar_notificaciones(mensajes)):
+            if n:
+                # Telegram admite alrededor de un mensaje por segundo en el mismo chat
+                await asyncio.sleep(1)
+            try:
+                await application.bot.send_message(chat_id=int(CHAT_ID), text=bloque)
+            except Exception as e:
+                print(f"[ERROR] Enviando notificación por Telegram: {e}")
+
+# --- Métricas ---
+# Contadores y duraciones por etapa en memoria, con etiquetas. Se consultan con
+# /metrics y, si METRICS_PORT está definido, en formato texto de Prometheus.
+_metricas = {}
+_metricas_lock = threading.Lock()
+ultimos_articulos = collections.deque(maxlen=50)
+# Tamaño y ajustes de imagen de la última edición construida
+ultimo_ajuste_epub = {}
+
+def _serie(nombre, tipo, etiquetas):
+    metrica = _metricas.setdefault(nombre, {"tipo": tipo, "series": {}})
+    return metrica["series"], tuple(sorted(etiquetas.items()))
+
+def contar(nombre, valor=1, **etiquetas):
+    with _metricas_lock:
+        series, clave = _serie(nombre, "counter", etiquetas)
+        series[clave] = series.get(clave, 0) + valor
+
+def observar(nombre, segundos, **etiquetas):
+    with _metricas_lock:
+        series, clave = _serie(nombre, "summary", etiquetas)
+        serie = series.setdefault(clave, {"count": 0, "sum": 0.0, "max": 0.0, "ultimo": 0.0})
+        serie["count"] += 1
+        serie["sum"] += segundos
+        serie["max"] = max(serie["max"], segundos)
+        serie["ultimo"] = segundos
+
+@contextlib.contextmanager
+def medir(etapa, **etiquetas):
+    inicio = time.monotonic()
+    try:
+        yield
+    except Exception:
+        contar("raspinews_errores_total", etapa=etapa)
+        raise
+    finally:
+        observar("raspinews_etapa_segundos", time.monotonic() - inicio, etapa=etapa, **etiquetas)
+
+def _etiquetas_prometheus(clave, extra=()):
+    pares = list(clave) + list(extra)
+    if not pares:
+        return ""
+    escapar = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escapar(v)}"' for k, v in pares) + "}"
+
+def texto_prometheus():
+    lineas = []
+    with _metricas_lock:
+        for nombre, metrica in sorted(_metricas.items()):
+            lineas.append(f"# TYPE {nombre} {metrica['tipo']}")
+            for clave, valor in metrica["series"].items():
+                if metrica["tipo"] == "counter":
+                    lineas.append(f"{nombre}{_etiquetas_prometheus(clave)} {valor}")
+                else:
+                    lineas.append(f"{nombre}_count{_etiquetas_prometheus(clave)} {valor['count']}")
+                    lineas.append(f"{nombre}_sum{_etiquetas_prometheus(clave)} {valor['sum']:.6f}")
+            if metrica["tipo"] == "summary":
+                lineas.append(f"# TYPE {nombre}_max gauge")
+                for clave, valor in metrica["series"].items():
+                    lineas.append(f"{nombre}_max{_etiquetas_prometheus(clave)} {valor['max']:.6f}")
+    return "\n".join(lineas) + "\n"
+
+def resumen_metricas():
+    with _metricas_lock:
+        etapas = dict(_metricas.get("raspinews_etapa_segundos", {}).get("series", {}))
+        contadores = {
+            nombre: dict(m["series"]) for nombre, m in _metricas.items() if m["tipo"] == "counter"
+        }
+        fuentes = dict(_metricas.get("raspinews_feed_segundos", {}).get("series", {}))
+    lineas = ["⏱ Etapas (última / media / máx, segundos):"]
+    for clave, serie in sorted(etapas.items()):
+        nombre = ",".join(f"{v}" for _, v in clave)
+        media = serie["sum"] / serie["count"]
+        lineas.append(f"- {nombre}: {serie['ultimo']:.2f} / {media:.2f} / {serie['max']:.2f} (n={serie['count']})")
+    if fuentes:
+        lineas.append("🐢 Fuentes más lentas (última consulta):")
+        for clave, serie in sorted(fuentes.items(), key=lambda kv: -kv[1]["ultimo"])[:5]:
+            lineas.append(f"- {dict(clave).get('fuente')}: {serie['ultimo']:.2f}s")
+    if ultimos_articulos:
+        lineas.append("🐢 Artículos más lentos (recientes):")
+        for url, segundos in sorted(ultimos_articulos, key=lambda a: -a[1])[:5]:
+            lineas.append(f"- {segundos:.2f}s {url}")
+    lineas.append("🔢 Contadores:")
+    for nombre, series in sorted(contadores.items()):
+        for clave, valor in series.items():
+            etiquetas = ",".join(f"{k}={v}" for k, v in clave)
+            lineas.append(f"- {nombre}{{{etiquetas}}}: {valor:g}")
+    return "\n".join(lineas)
+
+class ManejadorMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        cuerpo = texto_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, *args):
+        pass
+
+def iniciar_servidor_metricas():
+    # Sólo escucha en localhost; el scraper de Prometheus debe correr en la misma Pi
+    servidor = ThreadingHTTPServer(("127.0.0.1", METRICS_PORT), ManejadorMetricas)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    print(f"[LOG] Métricas Prometheus en http://127.0.0.1:{METRICS_PORT}/metrics")
+    return servidor
 
+# --- Estado en disco ---
+# Caché en memoria del contenido ya decodificado de cada archivo de estado,
+# invalidada cuando cambian su mtime o tamaño. Las escrituras son atómicas
+# (archivo temporal en el mismo directorio + os.replace) y actualizan la caché,
+# así ningún lector ve un archivo a medio escribir ni se repite el descifrado.
+_estado = {}
+_estado_lock = threading.RLock()
+
+def firma_archivo(ruta):
+    try:
+        st = os.stat(ruta)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def leer_estado(ruta, decodificar, vacio):
+    with _estado_lock:
+        firma = firma_archivo(ruta)
+        if firma is None:
+            return copy.deepcopy(vacio)
+        entrada = _estado.get(ruta)
+        if entrada is None or entrada[0] != firma:
+            with open(ruta, "rb") as f:
+                entrada = _estado[ruta] = (firma, decodificar(f.read()))
+        return copy.deepcopy(entrada[1])
+
+def escribir_estado(ruta, datos, codificar):
+    contenido = codificar(datos)
+    with _estado_lock:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ruta)), prefix=os.path.basename(ruta) + ".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(contenido)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, ruta)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+            raise
+        _estado[ruta] = (firma_archivo(ruta), copy.deepcopy(datos))
+
+def codificar_json(datos):
+    return json.dumps(datos, ensure_ascii=False, indent=2).encode("utf-8")
+
+def decodificar_json(contenido):
+    return json.loads(contenido.decode("utf-8"))
+
+# --- Emails cifrados ---
 def guardar_emails(emails):
     debug_msg = f"[DEBUG guardar_emails] emails = {emails} {type(emails)}"
     print(debug_msg)
-    # Enviar debug por Telegram si es posible
-    try:
-        from telegram import Bot
-        token = os.getenv("TELEGRAM_TOKEN")
-        chat_id = os.getenv("TELEGRAM_USER_ID")
-        if token and chat_id:
-            bot = Bot(token=token)
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                asyncio.create_task(bot.send_message(chat_id=int(chat_id), text=debug_msg))
-            else:
-                loop.run_until_complete(bot.send_message(chat_id=int(chat_id), text=debug_msg))
-    except Exception as e:
-        print(f"[DEBUG guardar_emails] Error enviando debug por Telegram: {e}")
+    notificar(debug_msg)
     # Validar que solo se acepten listas de strings
     if not isinstance(emails, list):
         print("[ERROR] Emails debe ser una lista de strings. Limpiando emails.enc...")
-        if os.path.exists(EMAILS_FILE):
-            os.remove(EMAILS_FILE)
         emails = []
-    else:
-        for e in emails:
-            if not isinstance(e, str):
-                print("[ERROR] Cada email debe ser un string. Limpiando emails.enc...")
-                if os.path.exists(EMAILS_FILE):
-                    os.remove(EMAILS_FILE)
-                emails = []
-                break
-    data = json.dumps(emails).encode()
-    encrypted = fernet.encrypt(data)
-    with open(EMAILS_FILE, "wb") as f:
-        f.write(encrypted)
+    elif not all(isinstance(e, str) for e in emails):
+        print("[ERROR] Cada email debe ser un string. Limpiando emails.enc...")
+        emails = []
+    escribir_estado(EMAILS_FILE, emails, lambda datos: obtener_fernet().encrypt(json.dumps(datos).encode()))
 
 def cargar_emails():
-    if not os.path.exists(EMAILS_FILE):
-        return []
-    with open(EMAILS_FILE, "rb") as f:
-        encrypted = f.read()
     try:
-        data = fernet.decrypt(encrypted)
-        return json.loads(data.decode())
+        return leer_estado(EMAILS_FILE, lambda contenido: json.loads(obtener_fernet().decrypt(contenido).decode()), [])
     except Exception as e:
         print(f"[ERROR] Descifrando emails: {e}")
         return []
 
-def guardar_fuentes(fuentes):
-    debug_msg = f"[DEBUG guardar_fuentes] fuentes = {fuentes} {type(fuentes)}"
-    print(debug_msg)
+# --- Fuentes de noticias ---
+def cargar_fuentes():
     try:
-        from telegram import Bot
-        token = os.getenv("TELEGRAM_TOKEN")
-        chat_id = os.getenv("TELEGRAM_USER_ID")
-        if token and chat_id:
-            bot = Bot(token=token)
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                asyncio.create_task(bot.send_message(chat_id=int(chat_id), text=debug_msg))
-            else:
-                loop.run_until_complete(bot.send_message(chat_id=int(chat_id), text=debug_msg))
+        return leer_estado(NEWS_SOURCES_FILE, decodificar_json, [])
     except Exception as e:
-        print(f"[DEBUG guardar_fuentes] Error enviando debug por Telegram: {e}")
-    # Permitir guardar como dict o lista
-    with open(NEWS_SOURCES_FILE, "w", encoding="utf-8") as f:
-        json.dump(fuentes, f, ensure_ascii=False, indent=2)
+        print(f"[ERROR] Cargando fuentes: {e}")
+        return []
 
-def cargar_fuentes():
-    if not os.path.exists(NEWS_SOURCES_FILE):
-        return {}
-    with open(NEWS_SOURCES_FILE, "r", encoding="utf-8") as f:
-        try:
-            fuentes = json.load(f)
-            if isinstance(fuentes, list):
-                # Convertir lista a dict
-                fuentes = {f"Source {i+1}": url for i, url in enumerate(fuentes)}
-            return fuentes
-        except Exception as e:
-            print(f"[ERROR] Cargando fuentes: {e}")
-            return {}
+def guardar_fuentes(fuentes):
+    notificar(f"[DEBUG guardar_fuentes] fuentes = {fuentes}")
+    escribir_estado(NEWS_SOURCES_FILE, fuentes, codificar_json)
 
-def guardar_enviadas(enviadas):
-    debug_msg = f"[DEBUG guardar_enviadas] enviadas = {enviadas} {type(enviadas)}"
-    print(debug_msg)
+# --- Suscripciones ---
+# Cada correo puede tener sus propias fuentes y palabras bloqueadas, cifradas
+# igual que los correos: {email: {"fuentes": [{"name", "rss"}], "banwords": [...]}}.
+# Sin fuentes propias, el correo usa las fuentes generales.
+def cargar_suscripciones():
     try:
-        from telegram import Bot
-        token = os.getenv("TELEGRAM_TOKEN")
-        chat_id = os.getenv("TELEGRAM_USER_ID")
-        if token and chat_id:
-            bot = Bot(token=token)
-            loop = asyncio.get_event_loop()
-            if loop.is_running():
-                asyncio.create_task(bot.send_message(chat_id=int(chat_id), text=debug_msg))
-            else:
-                loop.run_until_complete(bot.send_message(chat_id=int(chat_id), text=debug_msg))
+        return leer_estado(
+            SUBSCRIPTIONS_FILE, lambda contenido: json.loads(obtener_fernet().decrypt(contenido).decode()), {}
+        )
     except Exception as e:
-        print(f"[DEBUG guardar_enviadas] Error enviando debug por Telegram: {e}")
-    # Siempre guardar como lista
-    with open(SENT_NEWS_FILE, "w", encoding="utf-8") as f:
-        json.dump(list(enviadas), f, ensure_ascii=False, indent=2)
-
-def cargar_enviadas():
-    if not os.path.exists(SENT_NEWS_FILE):
-        return set()
-    with open(SENT_NEWS_FILE, "r", encoding="utf-8") as f:
-        try:
-            data = json.load(f)
-            return set(data)
-        except Exception as e:
-            print(f"[ERROR] Cargando enviadas: {e}")
-            return set()
+        print(f"[ERROR] Descifrando suscripciones: {e}")
+        return {}
 
-    data = json.dumps(emails).encode()
-    encrypted = fernet.encrypt(data)
-    with open(EMAILS_FILE, "wb") as f:
-        f.write(encrypted)
+def guardar_suscripciones(suscripciones):
+    escribir_estado(
+        SUBSCRIPTIONS_FILE, suscripciones, lambda datos: obtener_fernet().encrypt(json.dumps(datos).encode())
+    )
 
-def cargar_emails():
-    if not os.path.exists(EMAILS_FILE):
-        return []
-    with open(EMAILS_FILE, "rb") as f:
-        encrypted = f.read()
-        try:
-            data = fernet.decrypt(encrypted)
-            return json.loads(data.decode())
-        except Exception as e:
-            print(f"[ERROR] Error al descifrar emails: {e}")
-            return []
+def suscripcion(suscripciones, email):
+    datos = suscripciones.get(email, {})
+    return {"fuentes": list(datos.get("fuentes", [])), "banwords": list(datos.get("banwords", []))}
 
-# --- Fuentes de noticias ---
-def cargar_fuentes():
-    if not os.path.exists(NEWS_SOURCES_FILE):
-        return []
-    with open(NEWS_SOURCES_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+# --- Noticias enviadas ---
+# Se guardan en SQLite por destinatario (destinatario, url, fecha, fuente, guid):
+# lo que recibe un suscriptor no se oculta a los demás. El destinatario es el
+# correo, o PROPIETARIO para la copia por Telegram. Las entradas más antiguas que
+# SENT_NEWS_RETENTION_DAYS se eliminan al registrar.
+PROPIETARIO = "telegram"
+_db_enviadas = None
+_db_enviadas_lock = threading.Lock()
 
-def guardar_fuentes(fuentes):
-    with open(NEWS_SOURCES_FILE, "w", encoding="utf-8") as f:
-        json.dump(fuentes, f, ensure_ascii=False, indent=2)
+def db_enviadas():
+    global _db_enviadas
+    if _db_enviadas is None:
+        con = sqlite3.connect(SENT_NEWS_DB, check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS enviadas (destinatario TEXT NOT NULL, url TEXT NOT NULL, "
+            "fecha REAL NOT NULL, fuente TEXT, guid TEXT, PRIMARY KEY (destinatario, url))"
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS enviadas_fecha ON enviadas (fecha)")
+        con.execute("CREATE INDEX IF NOT EXISTS enviadas_url ON enviadas (url)")
+        con.execute("CREATE INDEX IF NOT EXISTS enviadas_guid ON enviadas (guid)")
+        # Rasgos (palabras con hash) de lo enviado a cada destinatario, para descartar
+        # la misma nota en días siguientes
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS rasgos (destinatario TEXT NOT NULL, url TEXT NOT NULL, "
+            "rasgos BLOB NOT NULL, fecha REAL NOT NULL, PRIMARY KEY (destinatario, url))"
+        )
+        con.execute("CREATE INDEX IF NOT EXISTS rasgos_fecha ON rasgos (fecha)")
+        migrar_enviadas_json(con)
+        _db_enviadas = con
+    return _db_enviadas
 
-# --- Noticias enviadas ---
-def cargar_enviadas():
+def migrar_enviadas_json(con):
+    # Importa el antiguo sent_news.json una única vez. Aquella lista era común a
+    # todos, así que cuenta como enviada al propietario y a los correos registrados.
     if not os.path.exists(SENT_NEWS_FILE):
-        return set()
-    with open(SENT_NEWS_FILE, "r", encoding="utf-8") as f:
-        return set(json.load(f))
+        return
+    try:
+        with open(SENT_NEWS_FILE, "r", encoding="utf-8") as f:
+            urls = json.load(f)
+        ahora = time.time()
+        with con:
+            con.executemany(
+                "INSERT OR IGNORE INTO enviadas (destinatario, url, fecha, fuente) VALUES (?, ?, ?, NULL)",
+                [(destinatario, url, ahora) for destinatario in [PROPIETARIO] + cargar_emails() for url in urls],
+            )
+        os.replace(SENT_NEWS_FILE, SENT_NEWS_FILE + ".migrado")
+        print(f"[LOG] Migradas {len(urls)} noticias enviadas a {SENT_NEWS_DB}")
+    except Exception as e:
+        print(f"[ERROR] Migrando enviadas: {e}")
+
+def ya_enviada(destinatarios, url, guid=None):
+    # True si la entrada ya llegó a todos los destinatarios indicados. El guid
+    # reconoce la misma entrada aunque la fuente cambie su enlace.
+    destinatarios = set(destinatarios)
+    if not destinatarios:
+        return False
+    marcas = ",".join("?" * len(destinatarios))
+    with _db_enviadas_lock:
+        (recibida,) = db_enviadas().execute(
+            f"SELECT COUNT(DISTINCT destinatario) FROM enviadas "
+            f"WHERE destinatario IN ({marcas}) AND (url = ? OR guid = ?)",
+            (*destinatarios, url, guid or None),
+        ).fetchone()
+    return recibida == len(destinatarios)
 
-def guardar_enviadas(news):
-    with open(SENT_NEWS_FILE, "w", encoding="utf-8") as f:
-        json.dump(list(news), f, ensure_ascii=False, indent=2)
+def registrar_enviadas(noticias, destinatarios):
+    # noticias: entradas de seleccionar_noticias (link, guid, fuente y rasgos)
+    # entregadas a cada uno de `destinatarios`
+    ahora = time.time()
+    with _db_enviadas_lock:
+        con = db_enviadas()
+        with con:
+            con.executemany(
+                "INSERT OR REPLACE INTO enviadas (destinatario, url, fecha, fuente, guid) VALUES (?, ?, ?, ?, ?)",
+                [(d, n["link"], ahora, n["fuente"], n.get("guid") or None) for d in destinatarios for n in noticias],
+            )
+            con.executemany(
+                "INSERT OR REPLACE INTO rasgos (destinatario, url, rasgos, fecha) VALUES (?, ?, ?, ?)",
+                [
+                    (d, n["link"], rasgos_a_sqlite(n["rasgos"]), ahora)
+                    for d in destinatarios for n in noticias if n.get("rasgos")
+                ],
+            )
+            con.execute("DELETE FROM enviadas WHERE fecha < ?", (ahora - SENT_NEWS_RETENTION_DAYS * 86400,))
+            con.execute("DELETE FROM rasgos WHERE fecha < ?", (ahora - DUPLICATE_DAYS * 86400,))
+
+def rasgos_recientes(destinatario):
+    with _db_enviadas_lock:
+        filas = db_enviadas().execute(
+            "SELECT rasgos FROM rasgos WHERE destinatario = ? AND fecha >= ?",
+            (destinatario, time.time() - DUPLICATE_DAYS * 86400),
+        ).fetchall()
+    return [frozenset(array.array("I", datos)) for (datos,) in filas]
+
+def rasgos_a_sqlite(rasgos):
+    return array.array("I", sorted(rasgos)).tobytes()
+
+def contar_enviadas():
+    with _db_enviadas_lock:
+        return db_enviadas().execute("SELECT COUNT(DISTINCT url) FROM enviadas").fetchone()[0]
 
 # --- Utilidades EPUB e imágenes ---
-def optimizar_imagen(imagen_bytes):
+def optimizar_imagen(imagen_bytes, lado=IMAGEN_MAX_LADO, calidad=IMAGEN_CALIDAD):
+    Image = modulo("PIL.Image")
     with Image.open(io.BytesIO(imagen_bytes)) as im:
+        # En JPEG decodifica directamente a escala reducida (1/2, 1/4, 1/8)
+        im.draft("RGB", (lado, lado))
         im = im.convert("RGB")
-        im.thumbnail((1200, 1200))
+        im.thumbnail((lado, lado))
         salida = io.BytesIO()
-        im.save(salida, format="JPEG", quality=85)
+        im.save(salida, format="JPEG", quality=calidad)
         return salida.getvalue()
 
-def crear_epub_con_noticias(urls, archivo_salida):
+# --- Caché de artículos en disco ---
+# Cada artículo se guarda como <clave>.json más sus imágenes <clave>_<n>.jpg.
+# El mtime más reciente de la entrada (el .json se toca en cada acierto)
+# marca su último uso para el desalojo LRU.
+estadisticas_cache = {"aciertos": 0, "fallos": 0}
+_estadisticas_lock = threading.Lock()
+
+def clave_cache(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()[:32]
+
+def escribir_atomico(ruta, datos):
+    # Temporal único en el mismo directorio + os.replace: la precarga y una edición
+    # pueden escribir la misma entrada a la vez sin pisarse ni dejarla a medias
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(ruta)), prefix=os.path.basename(ruta) + ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(datos)
+        os.replace(tmp, ruta)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+def contar_cache(campo):
+    with _estadisticas_lock:
+        estadisticas_cache[campo] += 1
+    contar("raspinews_cache_total", cache="articulos", resultado=campo)
+
+def leer_cache_articulo(url):
+    ruta = os.path.join(ARTICLE_CACHE_DIR, clave_cache(url) + ".json")
+    try:
+        with open(ruta, "r", encoding="utf-8") as f:
+            datos = json.load(f)
+        if datos.get("url") != url or time.time() - datos["fecha"] > ARTICLE_CACHE_TTL:
+            contar_cache("fallos")
+            return None
+        articulo = articulo_de_entrada(datos)
+        os.utime(ruta)
+    except (OSError, ValueError, KeyError):
+        contar_cache("fallos")
+        return None
+    contar_cache("aciertos")
+    return articulo
+
+def articulo_de_entrada(datos):
+    imagenes = []
+    for nombre in datos["imagenes"]:
+        with open(os.path.join(ARTICLE_CACHE_DIR, nombre), "rb") as f:
+            imagenes.append(f.read())
+    return {"titulo": datos["titulo"], "texto": datos["texto"], "imagenes": imagenes}
+
+def articulo_en_cache(url):
+    # Lectura interna (EPUB, archivo): sin TTL, sin contar aciertos ni renovar el uso LRU
+    try:
+        with open(os.path.join(ARTICLE_CACHE_DIR, clave_cache(url) + ".json"), "r", encoding="utf-8") as f:
+            datos = json.load(f)
+        return articulo_de_entrada(datos) if datos.get("url") == url else None
+    except (OSError, ValueError, KeyError):
+        return None
+
+def guardar_cache_articulo(url, articulo):
+    os.makedirs(ARTICLE_CACHE_DIR, exist_ok=True)
+    clave = clave_cache(url)
+    nombres = []
+    try:
+        for idx, img_data in enumerate(articulo["imagenes"]):
+            nombre = f"{clave}_{idx}.jpg"
+            escribir_atomico(os.path.join(ARTICLE_CACHE_DIR, nombre), img_data)
+            nombres.append(nombre)
+        datos = {
+            "url": url,
+            "fecha": time.time(),
+            "titulo": articulo["titulo"],
+            "texto": articulo["texto"],
+            "imagenes": nombres,
+        }
+        # El .json se escribe al final: sólo entonces la entrada es válida
+        escribir_atomico(
+            os.path.join(ARTICLE_CACHE_DIR, clave + ".json"), json.dumps(datos, ensure_ascii=False).encode("utf-8")
+        )
+    except OSError as e:
+        print(f"[ERROR] Guardando artículo en caché: {e}")
+
+def podar_cache(directorio, ttl, max_bytes):
+    # Elimina lo que no se ha usado en `ttl` segundos y luego lo menos usado
+    # hasta quedar bajo `max_bytes`. Los archivos se agrupan por su clave (32 caracteres).
+    if not os.path.isdir(directorio):
+        return
+    entradas = {}
+    for nombre in os.listdir(directorio):
+        ruta = os.path.join(directorio, nombre)
+        try:
+            st = os.stat(ruta)
+        except OSError:
+            continue
+        entrada = entradas.setdefault(nombre[:32], {"uso": 0, "bytes": 0, "rutas": []})
+        entrada["bytes"] += st.st_size
+        entrada["rutas"].append(ruta)
+        entrada["uso"] = max(entrada["uso"], st.st_mtime)
+    ahora = time.time()
+    total = sum(e["bytes"] for e in entradas.values())
+    for entrada in sorted(entradas.values(), key=lambda e: e["uso"]):
+        if ahora - entrada["uso"] <= ttl and total <= max_bytes:
+            break
+        for ruta in entrada["rutas"]:
+            try:
+                os.remove(ruta)
+            except OSError:
+                pass
+        total -= entrada["bytes"]
+
+# --- Motor de imágenes ---
+# Un solo pool de procesos para todo el bot, creado en el primer uso y cerrado
+# al detenerlo. Los trabajadores nacen de un proceso forkserver limpio y no de un
+# fork del bot: un fork con hilos a mitad de un import heredaría el lock tomado.
+_pool_imagenes = None
+_pool_imagenes_lock = threading.Lock()
+
+def pool_imagenes():
+    global _pool_imagenes
+    with _pool_imagenes_lock:
+        if _pool_imagenes is None:
+            _pool_imagenes = ProcessPoolExecutor(
+                max_workers=max(1, IMAGE_WORKERS), mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _pool_imagenes
+
+def cerrar_pool_imagenes(pool=None):
+    # Con `pool`, sólo si sigue siendo el actual (p. ej. uno roto por un trabajador muerto)
+    global _pool_imagenes
+    with _pool_imagenes_lock:
+        if _pool_imagenes is None or pool not in (None, _pool_imagenes):
+            return
+        _pool_imagenes.shutdown(wait=False, cancel_futures=True)
+        _pool_imagenes = None
+
+class ProcesadorImagenes:
+    # Optimiza imágenes en el pool compartido. Cada contenido distinto (por hash)
+    # se procesa una sola vez por edición y el resultado se guarda en IMAGE_CACHE_DIR.
+    def __init__(self):
+        self.futuros = {}
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+    def cerrar(self):
+        podar_cache(IMAGE_CACHE_DIR, IMAGE_CACHE_TTL, IMAGE_CACHE_MAX_BYTES)
+
+    def optimizar(self, imagen_bytes):
+        clave = hashlib.sha256(imagen_bytes).hexdigest()[:32]
+        with self.lock:
+            futuro = self.futuros.get(clave)
+            propio = futuro is None
+            if propio:
+                futuro = self.futuros[clave] = Future()
+        if propio:
+            try:
+                futuro.set_result(self._calcular(clave, imagen_bytes))
+            except Exception as e:
+                futuro.set_exception(e)
+        return futuro.result()
+
+    def _calcular(self, clave, imagen_bytes):
+        ruta = os.path.join(IMAGE_CACHE_DIR, clave + ".jpg")
+        try:
+            with open(ruta, "rb") as f:
+                datos = f.read()
+            os.utime(ruta)
+            contar("raspinews_cache_total", cache="imagenes", resultado="aciertos")
+            return datos
+        except OSError:
+            contar("raspinews_cache_total", cache="imagenes", resultado="fallos")
+        pool = pool_imagenes()
+        try:
+            with medir("optimizar_imagen"):
+                datos = pool.submit(optimizar_imagen, imagen_bytes).result(timeout=IMAGE_TIMEOUT)
+        except BrokenProcessPool:
+            # Un trabajador murió (p. ej. sin memoria): el próximo uso crea otro pool
+            cerrar_pool_imagenes(pool)
+            raise
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        escribir_atomico(ruta, datos)
+        return datos
+
+# --- Cliente HTTP compartido ---
+# Feeds, artículos e imágenes usan una sola sesión con conexiones persistentes
+# por host. Las respuestas se leen en streaming y se cortan al pasar el límite
+# de bytes (ya descomprimidos) o si el Content-Type no es el esperado.
+TIPOS_FEED = ("xml", "rss", "atom", "text/")
+TIPOS_ARTICULO = ("html",)
+TIPOS_IMAGEN = ("image/",)
+_sesion_http = None
+_sesion_http_lock = threading.Lock()
+
+class ErrorDescarga(Exception):
+    pass
+
+def sesion_http():
+    global _sesion_http
+    with _sesion_http_lock:
+        if _sesion_http is None:
+            Retry = modulo("urllib3.util.retry").Retry
+            adaptador = requests.adapters.HTTPAdapter(
+                pool_connections=32,
+                pool_maxsize=max(HTTP_POOL_SIZE, ARTICLE_PER_HOST),
+                max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.5,
+                                  status_forcelist=(502, 503, 504), allowed_methods=["GET"]),
+            )
+            sesion = requests.Session()
+            sesion.mount("http://", adaptador)
+            sesion.mount("https://", adaptador)
+            sesion.headers["User-Agent"] = "Mozilla/5.0 (X11; Linux armv7l) RaspiNews"
+            _sesion_http = sesion
+        return _sesion_http
+
+class LecturaLimitada:
+    # Flujo de la respuesta que falla al superar `limite` bytes descomprimidos
+    # o, si hay `plazo` (instante de time.monotonic), al pasar ese momento
+    def __init__(self, crudo, limite, url, plazo=None):
+        self.crudo = crudo
+        self.limite = limite
+        self.url = url
+        self.plazo = plazo
+        self.leidos = 0
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            partes = []
+            while True:
+                parte = self.read(64 * 1024)
+                if not parte:
+                    return b"".join(partes)
+                partes.append(parte)
+        datos = self.crudo.read(n)
+        self.leidos += len(datos)
+        if self.leidos > self.limite:
+            raise ErrorDescarga(f"{self.url} supera {self.limite // 1024} KB")
+        if self.plazo is not None and time.monotonic() > self.plazo:
+            raise ErrorDescarga(f"{self.url}: tiempo agotado leyendo la respuesta")
+        return datos
+
+@contextlib.contextmanager
+def abrir_url(url, limite, tipos=None, headers=None, timeout=ARTICLE_REQUEST_TIMEOUT, plazo=None):
+    # Entrega (respuesta, flujo limitado); con un estado de error el flujo es None.
+    # `timeout` vale por operación de red; `plazo` limita en segundos la descarga completa.
+    limite_tiempo = time.monotonic() + plazo if plazo else None
+    with sesion_http().get(url, headers=headers, timeout=timeout, stream=True) as resp:
+        if not resp.ok:
+            yield resp, None
+            return
+        tipo = resp.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if tipos and tipo and not any(t in tipo for t in tipos):
+            raise ErrorDescarga(f"{url}: tipo de contenido inesperado {tipo}")
+        longitud = resp.headers.get("Content-Length", "")
+        if longitud.isdigit() and int(longitud) > limite:
+            raise ErrorDescarga(f"{url} anuncia {int(longitud) // 1024} KB, límite {limite // 1024} KB")
+        resp.raw.decode_content = True
+        yield resp, LecturaLimitada(resp.raw, limite, url, limite_tiempo)
+
+def descargar_url(url, limite, tipos=None, timeout=ARTICLE_REQUEST_TIMEOUT):
+    # Cuerpo completo de la respuesta (bytes) o excepción
+    with abrir_url(url, limite, tipos, timeout=timeout) as (resp, flujo):
+        resp.raise_for_status()
+        return resp, flujo.read()
+
+def descargar_html(url):
+    # Como newspaper: texto si el servidor declara el charset, si no bytes
+    # para que lxml lo detecte en el <meta> del documento
+    resp, datos = descargar_url(url, ARTICLE_MAX_BYTES, TIPOS_ARTICULO, ARTICLE_REQUEST_TIMEOUT)
+    if "charset" in resp.headers.get("Content-Type", "").lower():
+        return datos.decode(resp.encoding, errors="replace"), len(datos)
+    return datos, len(datos)
+
+# --- Descarga paralela de artículos ---
+_semaforos_host = {}
+_semaforos_lock = threading.Lock()
+
+def semaforo_host(url):
+    # Limita las conexiones simultáneas a un mismo sitio
+    host = urlparse(url).netloc.lower()
+    with _semaforos_lock:
+        if host not in _semaforos_host:
+            _semaforos_host[host] = threading.BoundedSemaphore(ARTICLE_PER_HOST)
+        return _semaforos_host[host]
+
+# --- Extracción de artículos por niveles ---
+# 1) el contenido que ya trae el feed (content:encoded o un resumen largo),
+# 2) un extractor ligero con lxml sobre la página, 3) newspaper como último recurso.
+# Cada nivel devuelve {"titulo", "texto", "imagen"} o None si no alcanza.
+ETIQUETAS_RUIDO = ("script", "style", "noscript", "nav", "header", "footer", "aside", "form", "iframe")
+
+def limpiar_espacios(texto):
+    return re.sub(r"\s+", " ", texto).strip()
+
+def parrafos_de(nodo):
+    bloques = [limpiar_espacios(p.text_content()) for p in nodo.iter("p", "h2", "h3", "li", "blockquote")]
+    return "\n\n".join(b for b in bloques if b) or limpiar_espacios(nodo.text_content())
+
+def primera_imagen(nodo, base):
+    for img in nodo.iter("img"):
+        src = img.get("src") or img.get("data-src")
+        if src and not src.startswith("data:"):
+            return urljoin(base, src)
+    return None
+
+def extraer_de_feed(entrada, url):
+    contenido = entrada.get("content") or entrada.get("summary") or ""
+    if len(contenido) < EXTRACTION_MIN_CHARS:
+        return None
+    raiz = modulo("lxml.html").fragment_fromstring(contenido, create_parent="div")
+    modulo("lxml.etree").strip_elements(raiz, *ETIQUETAS_RUIDO, with_tail=False)
+    texto = parrafos_de(raiz)
+    if len(texto) < EXTRACTION_MIN_CHARS:
+        return None
+    return {"titulo": entrada.get("title", ""), "texto": texto, "imagen": primera_imagen(raiz, url)}
+
+def extraer_lxml(html, url):
+    lhtml = modulo("lxml.html")
+    if isinstance(html, str):
+        doc = lhtml.fromstring(html.encode("utf-8"), parser=lhtml.HTMLParser(encoding="utf-8"))
+    else:
+        doc = lhtml.fromstring(html)
+    meta = {
+        m.get("property") or m.get("name"): m.get("content")
+        for m in doc.iter("meta") if m.get("content")
+    }
+    titulo = meta.get("og:title") or limpiar_espacios(doc.findtext(".//title") or "")
+    modulo("lxml.etree").strip_elements(doc, *ETIQUETAS_RUIDO, with_tail=False)
+    # El cuerpo es el contenedor cuyos párrafos directos suman más texto
+    puntajes = {}
+    for p in doc.iter("p"):
+        largo = len(limpiar_espacios(p.text_content()))
+        if largo >= 40 and p.getparent() is not None:
+            puntajes[p.getparent()] = puntajes.get(p.getparent(), 0) + largo
+    if not puntajes:
+        return None
+    cuerpo = max(puntajes, key=puntajes.get)
+    texto = parrafos_de(cuerpo)
+    if len(texto) < EXTRACTION_MIN_CHARS:
+        return None
+    imagen = urljoin(url, meta["og:image"]) if meta.get("og:image") else primera_imagen(cuerpo, url)
+    return {"titulo": titulo, "texto": texto, "imagen": imagen}
+
+def extraer_newspaper(html, url):
+    # fetch_images=False: newspaper no descarga por su cuenta la imagen principal
+    article = modulo("newspaper").Article(url, fetch_images=False)
+    article.download(input_html=html)
+    article.parse()
+    imagen = article.meta_img or article.top_image or next(iter(article.images), None)
+    return {"titulo": article.title, "texto": article.text or "", "imagen": imagen}
+
+def intentar_extraccion(extractor, origen, url):
+    # Un nivel que falla no tumba el artículo: se pasa al siguiente
+    try:
+        return extractor(origen, url)
+    except Exception as e:
+        print(f"[LOG] {extractor.__name__} falló en {url}: {e}")
+        return None
+
+def descargar_articulo(url, procesador=None, entrada=None):
+    articulo = leer_cache_articulo(url)
+    if articulo is not None:
+        return articulo
+    inicio = time.monotonic()
+    extraido, metodo = (intentar_extraccion(extraer_de_feed, entrada, url) if entrada else None), "feed"
+    if extraido is None:
+        with semaforo_host(url):
+            with medir("descarga_articulo"):
+                html, tamano = descargar_html(url)
+        contar("raspinews_bytes_descargados_total", tamano, tipo="articulo")
+        with medir("parseo_articulo"):
+            extraido, metodo = intentar_extraccion(extraer_lxml, html, url), "lxml"
+            if extraido is None:
+                extraido, metodo = extraer_newspaper(html, url), "newspaper"
+    contar("raspinews_extraccion_total", metodo=metodo)
+    imagenes = []
+    if extraido["imagen"]:
+        img_url = extraido["imagen"]
+        try:
+            with semaforo_host(img_url):
+                with medir("descarga_imagen"):
+                    _, img_data_raw = descargar_url(img_url, IMAGE_MAX_BYTES, TIPOS_IMAGEN, timeout=5)
+            contar("raspinews_bytes_descargados_total", len(img_data_raw), tipo="imagen")
+            if procesador is None:
+                imagenes.append(optimizar_imagen(img_data_raw))
+            else:
+                imagenes.append(procesador.optimizar(img_data_raw))
+        except Exception as e:
+            print(f"Error con imagen: {e}")
+    # El título del feed suele venir limpio, sin el nombre del sitio
+    titulo = (entrada or {}).get("title") or extraido["titulo"]
+    articulo = {"titulo": titulo, "texto": extraido["texto"], "imagenes": imagenes}
+    guardar_cache_articulo(url, articulo)
+    segundos = time.monotonic() - inicio
+    observar("raspinews_articulo_segundos", segundos)
+    ultimos_articulos.append((url, segundos))
+    return articulo
+
+def descargar_articulos(urls, entradas=None):
+    # Descarga y procesa en paralelo, pero entrega en el orden original.
+    # Las noticias que fallan o exceden ARTICLE_TIMEOUT se entregan como None.
+    # `entradas` ({url: entrada del feed}) permite usar el contenido del feed.
+    entradas = entradas or {}
+    pool = ThreadPoolExecutor(max_workers=max(1, min(ARTICLE_WORKERS, len(urls))))
+    procesador = ProcesadorImagenes()
+    futuros = [pool.submit(descargar_articulo, url, procesador, entradas.get(url)) for url in urls]
+    limite = time.monotonic() + ARTICLE_TIMEOUT
+    try:
+        for i, url in enumerate(urls):
+            verificar_cancelacion()
+            # Soltar la referencia al futuro para no retener artículos ya entregados
+            futuro, futuros[i] = futuros[i], None
+            try:
+                yield i, url, futuro.result(timeout=max(0, limite - time.monotonic()))
+            except FuturesTimeout:
+                print(f"[ERROR] Tiempo agotado procesando noticia {url}")
+                contar("raspinews_errores_total", etapa="articulo_timeout")
+                yield i, url, None
+            except Exception as e:
+                print(f"Error procesando noticia {url}: {e}")
+                contar("raspinews_errores_total", etapa="articulo")
+                yield i, url, None
+    finally:
+        # No esperar a las descargas colgadas
+        pool.shutdown(wait=False, cancel_futures=True)
+        procesador.cerrar()
+        podar_cache(ARTICLE_CACHE_DIR, ARTICLE_CACHE_TTL, ARTICLE_CACHE_MAX_BYTES)
+
+# --- Escritura de EPUB ---
+class EscritorEpub:
+    # En modo streaming cada capítulo e imagen se escribe en el zip en cuanto
+    # se agrega y su contenido se descarta; el libro sólo conserva metadatos.
+    # Nav, NCX y OPF se generan al cerrar con el propio EpubWriter de ebooklib,
+    # así que el resultado es el mismo que produciría epub.write_epub.
+    def __init__(self, archivo_salida, libro, streaming=EPUB_STREAMING):
+        self.archivo_salida = archivo_salida
+        self.libro = libro
+        self.zip = None
+        if streaming:
+            self.zip = zipfile.ZipFile(archivo_salida, "w", zipfile.ZIP_DEFLATED, compresslevel=6)
+            self.zip.writestr("mimetype", "application/epub+zip", compress_type=zipfile.ZIP_STORED)
+
+    def agregar(self, item):
+        self.libro.add_item(item)
+        if self.zip is not None:
+            self.zip.writestr(f"{self.libro.FOLDER_NAME}/{item.file_name}", item.get_content())
+            item.content = b""
+
+    def cerrar(self):
+        with medir("escritura_epub"):
+            self._cerrar()
+
+    def _cerrar(self):
+        epub = modulo("ebooklib.epub")
+        if self.zip is None:
+            epub.write_epub(self.archivo_salida, self.libro)
+            return
+        # epub3_pages volvería a leer el cuerpo de cada capítulo buscando saltos
+        # de página; nuestros capítulos no los tienen, así que el nav no cambia
+        escritor = epub.EpubWriter(self.archivo_salida, self.libro, {"epub3_pages": False})
+        escritor.out = self.zip
+        escritor._write_container()
+        escritor._write_opf()
+        for item in self.libro.get_items():
+            ruta = f"{self.libro.FOLDER_NAME}/{item.file_name}"
+            if isinstance(item, epub.EpubNcx):
+                self.zip.writestr(ruta, escritor._get_ncx())
+            elif isinstance(item, epub.EpubNav):
+                self.zip.writestr(ruta, escritor._get_nav(item))
+            elif item.content:
+                # Elementos agregados directamente al libro (p. ej. la hoja de estilo)
+                self.zip.writestr(ruta, item.get_content())
+        self.zip.close()
+
+PLANTILLA_CAPITULO = (
+    "<h2>{titulo}</h2>{imagenes}"
+    "<div style='font-family:Arial; font-size:1em; line-height:1.6;'>{parrafos}</div>"
+)
+
+def renderizar_capitulo(titulo, rutas_imagenes, texto):
+    # Todo el contenido externo se escapa; el resultado es XHTML válido sin re-parsear
+    imagenes = "".join(
+        f'<div><img src="{escape(ruta)}" alt="" style="max-width:100%; margin-bottom:20px;"/></div>'
+        for ruta in rutas_imagenes
+    )
+    parrafos = "".join(f"<p>{escape(linea.strip())}</p>" for linea in texto.split("\n") if linea.strip())
+    return PLANTILLA_CAPITULO.format(titulo=escape(titulo), imagenes=imagenes, parrafos=parrafos)
+
+def crear_epub_con_noticias(urls, archivo_salida, entradas=None):
+    # Cada artículo descargado queda en la caché, de donde lo relee la segunda pasada
+    return escribir_epub(descargar_articulos(urls, entradas), archivo_salida, recargar=articulo_en_cache)
+
+def escribir_epub(articulos, archivo_salida, dia=None, recargar=None):
+    # articulos: iterable de (i, url, articulo o None), como descargar_articulos.
+    # Con presupuesto, la primera pasada sólo mide y `recargar(url)` vuelve a leer
+    # cada artículo al escribirlo; sin `recargar` no se aplica el presupuesto.
+    epub = modulo("ebooklib.epub")
     libro = epub.EpubBook()
-    fecha = datetime.now().strftime("%d/%m/%Y")
+    fecha = (dia or datetime.now()).strftime("%d/%m/%Y")
     titulo = f"RaspiNews México - {fecha}"
     libro.set_identifier("raspinews-diario")
     libro.set_title(titulo)
@@ -217,44 +1037,6 @@ def crear_epub_con_noticias(urls, archivo_salida):
     libro.add_metadata('DC', 'title', titulo)
     libro.add_metadata('DC', 'creator', "RaspiNews")
     libro.add_metadata('DC', 'language', "es")
-
-    capitulos = []
-    for i, url in enumerate(urls):
-        try:
-            article = Article(url)
-            article.download()
-            article.parse()
-            titulo = article.title or f"Noticia {i+1}"
-            texto = article.text or ""
-            imagenes = list(article.images)[:1]
-            html = f"<h2>{titulo}</h2>"
-            for idx, img_url in enumerate(imagenes):
-                try:
-                    img_data_raw = requests.get(img_url, timeout=5).content
-                    img_data = optimizar_imagen(img_data_raw)
-                    img_filename = f"noticia{i}_img{idx}.jpg"
-                    img_item = epub.EpubItem(
-                        uid=img_filename,
-                        file_name=f"images/{img_filename}",
-                        media_type="image/jpeg",
-                        content=img_data,
-                    )
-                    libro.add_item(img_item)
-                    html += f'<div><img src="{img_item.file_name}" style="max-width:100%; margin-bottom:20px;"></div>'
-                except Exception as e:
-                    print(f"Error con imagen: {e}")
-            html += "<div style='font-family:Arial; font-size:1em; line-height:1.6;'>" + texto.replace("\n", "<br>") + "</div>"
-            soup = BeautifulSoup(html, "html.parser")
-            capitulo = epub.EpubHtml(title=titulo, file_name=f"capitulo{i}.xhtml", lang="es")
-            capitulo.set_content(str(soup))
-            libro.add_item(capitulo)
-            capitulos.append(capitulo)
-        except Exception as e:
-            print(f"Error procesando noticia {url}: {e}")
-    libro.toc = tuple(capitulos)
-    libro.spine = ["nav"] + capitulos
-    libro.add_item(epub.EpubNcx())
-    libro.add_item(epub.EpubNav())
     estilo = """
     body { font-family: Georgia, serif; margin: 2em; color: #333; }
     h2 { color: #0055a5; }
@@ -263,44 +1045,447 @@ def crear_epub_con_noticias(urls, archivo_salida):
     estilo_item = epub.EpubItem(
         uid="style_nav", file_name="style/style.css", media_type="text/css", content=estilo
     )
-    libro.add_item(estilo_item)
-    for cap in capitulos:
-        cap.add_item(estilo_item)
-    epub.write_epub(archivo_salida, libro)
+
+    # Devuelve cuántas noticias se incluyeron
+    ajuste = None
+    if EPUB_MAX_BYTES and recargar is not None:
+        with medir("presupuesto_epub"):
+            presentes, ajuste = planificar_presupuesto(articulos, EPUB_MAX_BYTES)
+        articulos = imagenes_ajustadas(((i, url, recargar(url)) for i, url in presentes), ajuste)
+    # El zip se abre después de planificar: si la edición se cancela o una descarga
+    # falla durante la primera pasada no queda un descriptor abierto sobre el archivo
+    escritor = EscritorEpub(archivo_salida, libro)
+    capitulos = []
+    try:
+        for i, url, articulo in articulos:
+            if articulo is None:
+                if ajuste is not None:
+                    print(f"[ERROR] {url} ya no está disponible para escribir el EPUB")
+                continue
+            titulo = articulo["titulo"] or f"Noticia {i+1}"
+            rutas_imagenes = []
+            for idx, img_data in enumerate(articulo["imagenes"]):
+                img_filename = f"noticia{i}_img{idx}.jpg"
+                img_item = epub.EpubItem(
+                    uid=img_filename,
+                    file_name=f"images/{img_filename}",
+                    media_type="image/jpeg",
+                    content=img_data,
+                )
+                escritor.agregar(img_item)
+                rutas_imagenes.append(img_item.file_name)
+            capitulo = epub.EpubHtml(title=titulo, file_name=f"capitulo{i}.xhtml", lang="es")
+            capitulo.set_content(renderizar_capitulo(titulo, rutas_imagenes, articulo["texto"]))
+            capitulo.add_item(estilo_item)
+            escritor.agregar(capitulo)
+            capitulos.append(capitulo)
+        libro.toc = tuple(capitulos)
+        libro.spine = ["nav"] + capitulos
+        libro.add_item(epub.EpubNcx())
+        libro.add_item(epub.EpubNav())
+        libro.add_item(estilo_item)
+    finally:
+        escritor.cerrar()
+    if ajuste is not None:
+        reportar_ajuste(ajuste, os.path.getsize(archivo_salida))
+    return len(capitulos)
+
+# --- Presupuesto de tamaño del EPUB ---
+# Se planifica sólo con tamaños: una primera pasada anota cuánto ocupan el texto
+# (comprimido) y cada imagen, sin retener los artículos. Si la edición no cabe en
+# EPUB_MAX_BYTES se fija un tope por imagen que recorta primero las más grandes.
+# Al escribir, cada imagen que supera el tope se recomprime en el pool de imágenes
+# con la mayor resolución y calidad que caben; si ni así cabe, se quita.
+def planificar_presupuesto(articulos, presupuesto):
+    # Devuelve ([(i, url)] de los artículos presentes, ajuste con el tope por imagen)
+    presentes, tamanos = [], []
+    # Margen fijo para OPF, NCX, nav y estilos, más cada capítulo comprimido
+    texto = 4 * 1024
+    for i, url, articulo in articulos:
+        if articulo is None:
+            continue
+        presentes.append((i, url))
+        texto += len(zlib.compress(articulo["texto"].encode("utf-8"))) + 512
+        tamanos.extend(len(datos) for datos in articulo["imagenes"])
+    ajuste = {
+        "presupuesto": presupuesto, "tope": tope_imagenes(tamanos, presupuesto - texto),
+        "lado": IMAGEN_MAX_LADO, "calidad": IMAGEN_CALIDAD, "recomprimidas": 0, "descartadas": 0,
+    }
+    return presentes, ajuste
+
+def tope_imagenes(tamanos, objetivo):
+    # Mayor tope t con sum(min(tamaño, t)) <= objetivo, o None si todo cabe
+    if sum(tamanos) <= objetivo:
+        return None
+    restantes = len(tamanos)
+    for tamano in sorted(tamanos):
+        parte = objetivo / restantes
+        if tamano > parte:
+            # Ésta y todas las mayores quedan en el tope
+            return max(0, int(parte))
+        objetivo -= tamano
+        restantes -= 1
+    return 0
+
+def recomprimir_imagen(datos, tope):
+    # Corre en el pool: (JPEG de hasta `tope` bytes o None, lado, calidad)
+    for lado in IMAGEN_LADOS_AJUSTE:
+        elegida = optimizar_imagen(datos, lado, IMAGEN_CALIDAD_MIN)
+        if len(elegida) > tope:
+            continue
+        # Mayor calidad que todavía cabe
+        bajo, alto = IMAGEN_CALIDAD_MIN, IMAGEN_CALIDAD
+        while bajo < alto:
+            medio = (bajo + alto + 1) // 2
+            candidata = optimizar_imagen(datos, lado, medio)
+            if len(candidata) <= tope:
+                bajo, elegida = medio, candidata
+            else:
+                alto = medio - 1
+        return elegida, lado, bajo
+    return None, IMAGEN_LADOS_AJUSTE[-1], IMAGEN_CALIDAD_MIN
+
+def imagenes_ajustadas(articulos, ajuste):
+    # Envía al pool las imágenes que superan el tope con unos pocos artículos de
+    # adelanto, para recomprimir en paralelo sin retener la edición en memoria
+    tope = ajuste["tope"]
+    pool = pool_imagenes() if tope is not None else None
+    pendientes = collections.deque()
+
+    def entregar(i, url, articulo):
+        if articulo is None or tope is None:
+            return i, url, articulo
+        imagenes = []
+        for imagen in articulo["imagenes"]:
+            if isinstance(imagen, bytes):
+                imagenes.append(imagen)
+                continue
+            try:
+                datos, lado, calidad = imagen.result(timeout=IMAGEN_TIMEOUT_AJUSTE)
+            except Exception as e:
+                print(f"[ERROR] Recomprimiendo imagen de {url}: {e}")
+                if isinstance(e, BrokenProcessPool):
+                    cerrar_pool_imagenes(pool)
+                datos = None
+            if datos is None:
+                ajuste["descartadas"] += 1
+                continue
+            ajuste["recomprimidas"] += 1
+            ajuste["lado"] = min(ajuste["lado"], lado)
+            ajuste["calidad"] = min(ajuste["calidad"], calidad)
+            imagenes.append(datos)
+        articulo["imagenes"] = imagenes
+        return i, url, articulo
+
+    for i, url, articulo in articulos:
+        if articulo is not None and tope is not None:
+            articulo["imagenes"] = [
+                pool.submit(recomprimir_imagen, datos, tope) if len(datos) > tope else datos
+                for datos in articulo["imagenes"]
+            ]
+        pendientes.append((i, url, articulo))
+        if len(pendientes) > max(1, IMAGE_WORKERS):
+            yield entregar(*pendientes.popleft())
+    while pendientes:
+        yield entregar(*pendientes.popleft())
+
+def reportar_ajuste(ajuste, tamano):
+    ultimo_ajuste_epub.clear()
+    ultimo_ajuste_epub.update(ajuste, bytes=tamano)
+    linea = (
+        f"EPUB de {tamano / 1024:.0f} KB (presupuesto {ajuste['presupuesto'] / 1024:.0f} KB): "
+        f"imágenes hasta {ajuste['lado']}px calidad {ajuste['calidad']}, "
+        f"{ajuste['recomprimidas']} recomprimidas, {ajuste['descartadas']} descartadas"
+    )
+    print(f"[LOG] {linea}")
+    if ajuste["recomprimidas"] or ajuste["descartadas"] or tamano > ajuste["presupuesto"]:
+        notificar(linea)
+
+# --- Caché de ediciones ---
+# El EPUB terminado se guarda con una clave derivada de las URLs, el día (va en el
+# título del libro) y la versión de la plantilla: /generate, /force y la tarea
+# programada reutilizan el mismo archivo si el contenido no cambió (p. ej. reenviar
+# tras un fallo SMTP o a un correo nuevo). La caché se poda al terminar cada envío.
+# Dos pedidos simultáneos de la misma edición la construyen una vez; ediciones
+# distintas se construyen en paralelo.
+_ediciones_en_curso = {}
+_ediciones_lock = threading.Lock()
+
+def clave_edicion(urls):
+    dia = datetime.now().strftime("%Y%m%d")
+    contenido = "\n".join([f"v{PLANTILLA_EPUB_VERSION}", str(EPUB_MAX_BYTES), dia] + list(urls))
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()[:32]
+
+def ruta_edicion(clave):
+    return os.path.join(EDITION_CACHE_DIR, clave + ".epub")
+
+def obtener_edicion(urls, entradas=None):
+    # Ruta al EPUB con esas noticias, construyéndolo sólo si no está en caché
+    clave = clave_edicion(urls)
+    with _ediciones_lock:
+        futuro = _ediciones_en_curso.get(clave)
+        propio = futuro is None
+        if propio:
+            futuro = _ediciones_en_curso[clave] = Future()
+    if not propio:
+        return futuro.result()
+    try:
+        futuro.set_result(_construir_edicion(clave, urls, entradas))
+    except Exception as e:
+        futuro.set_exception(e)
+    finally:
+        with _ediciones_lock:
+            del _ediciones_en_curso[clave]
+    return futuro.result()
+
+def _construir_edicion(clave, urls, entradas):
+    ruta = ruta_edicion(clave)
+    if os.path.exists(ruta):
+        os.utime(ruta)
+        contar("raspinews_cache_total", cache="ediciones", resultado="aciertos")
+        print(f"[LOG] Edición {clave} reutilizada desde la caché")
+        return ruta
+    contar("raspinews_cache_total", cache="ediciones", resultado="fallos")
+    os.makedirs(EDITION_CACHE_DIR, exist_ok=True)
+    temporal = os.path.join(EDITION_CACHE_DIR, clave + ".tmp")
+    try:
+        incluidas = crear_epub_con_noticias(urls, temporal, entradas)
+        if incluidas < len(urls):
+            # Faltaron artículos: se entrega, pero el próximo pedido lo reconstruye
+            ruta = os.path.join(EDITION_CACHE_DIR, clave + ".parcial.epub")
+        os.replace(temporal, ruta)
+    finally:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+    return ruta
+
+# --- Archivo de artículos entregados ---
+# Cada artículo enviado queda en ARCHIVE_DB con el texto comprimido (zlib), sus
+# imágenes ya optimizadas y un índice FTS5 sin contenido propio (el texto sólo
+# se guarda una vez, comprimido). Permite /search y reconstruir con /resend
+# la edición que recibió cada destinatario un día, sin acceder a la red.
+_db_archivo = None
+_db_archivo_lock = threading.Lock()
+
+def db_archivo():
+    global _db_archivo
+    if _db_archivo is None:
+        con = sqlite3.connect(ARCHIVE_DB, check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS articulos (id INTEGER PRIMARY KEY, url TEXT UNIQUE NOT NULL, "
+            "titulo TEXT, fuente TEXT, fecha REAL NOT NULL, texto BLOB NOT NULL)"
+        )
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS imagenes (articulo INTEGER NOT NULL, orden INTEGER NOT NULL, "
+            "datos BLOB NOT NULL, PRIMARY KEY (articulo, orden))"
+        )
+        # Qué recibió cada destinatario (correo o PROPIETARIO) cada día (AAAAMMDD) y en qué orden
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS entregas (dia TEXT NOT NULL, destinatario TEXT NOT NULL, "
+            "orden INTEGER NOT NULL, articulo INTEGER NOT NULL, PRIMARY KEY (dia, destinatario, articulo))"
+        )
+        con.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS busqueda USING fts5("
+            "titulo, texto, content='', tokenize='unicode61 remove_diacritics 2')"
+        )
+        _db_archivo = con
+    return _db_archivo
+
+def archivar_entregas(noticias, destinatarios, dia=None):
+    # Guarda los artículos de la caché recién entregados a `destinatarios`;
+    # devuelve cuántos artículos nuevos se archivaron
+    dia = dia or datetime.now().strftime("%Y%m%d")
+    ahora = time.time()
+    archivados = 0
+    with _db_archivo_lock:
+        con = db_archivo()
+        with con:
+            ordenes = {
+                d: con.execute(
+                    "SELECT COUNT(*) FROM entregas WHERE dia = ? AND destinatario = ?", (dia, d)
+                ).fetchone()[0]
+                for d in destinatarios
+            }
+            for noticia in noticias:
+                url = noticia["link"]
+                fila = con.execute("SELECT id FROM articulos WHERE url = ?", (url,)).fetchone()
+                if fila is None:
+                    # Sin TTL ni contadores: una edición reutilizada puede ser más vieja que el TTL
+                    articulo = articulo_en_cache(url)
+                    if articulo is None:
+                        print(f"[LOG] Archivo: {url} ya no está en la caché, se omite")
+                        continue
+                    titulo = articulo["titulo"] or noticia.get("title", "")
+                    cursor = con.execute(
+                        "INSERT INTO articulos (url, titulo, fuente, fecha, texto) VALUES (?, ?, ?, ?, ?)",
+                        (url, titulo, noticia.get("fuente"), ahora, zlib.compress(articulo["texto"].encode("utf-8"), 9)),
+                    )
+                    fila = (cursor.lastrowid,)
+                    con.executemany(
+                        "INSERT INTO imagenes (articulo, orden, datos) VALUES (?, ?, ?)",
+                        [(fila[0], n, datos) for n, datos in enumerate(articulo["imagenes"])],
+                    )
+                    con.execute(
+                        "INSERT INTO busqueda (rowid, titulo, texto) VALUES (?, ?, ?)",
+                        (fila[0], titulo, articulo["texto"]),
+                    )
+                    archivados += 1
+                for destinatario in destinatarios:
+                    cursor = con.execute(
+                        "INSERT OR IGNORE INTO entregas (dia, destinatario, orden, articulo) VALUES (?, ?, ?, ?)",
+                        (dia, destinatario, ordenes[destinatario], fila[0]),
+                    )
+                    ordenes[destinatario] += cursor.rowcount
+            if ARCHIVE_RETENTION_DAYS:
+                podar_archivo(con, ahora - ARCHIVE_RETENTION_DAYS * 86400)
+    return archivados
+
+def podar_archivo(con, limite):
+    # Un índice sin contenido propio sólo se puede borrar pasándole los valores indexados
+    for id_, titulo, texto in con.execute(
+        "SELECT id, titulo, texto FROM articulos WHERE fecha < ?", (limite,)
+    ).fetchall():
+        con.execute(
+            "INSERT INTO busqueda (busqueda, rowid, titulo, texto) VALUES ('delete', ?, ?, ?)",
+            (id_, titulo, zlib.decompress(texto).decode("utf-8")),
+        )
+        con.execute("DELETE FROM imagenes WHERE articulo = ?", (id_,))
+        con.execute("DELETE FROM entregas WHERE articulo = ?", (id_,))
+        con.execute("DELETE FROM articulos WHERE id = ?", (id_,))
+
+def buscar_archivo(terminos, limite=10):
+    # Cada término se busca como frase literal para no exponer la sintaxis de FTS5
+    consulta = " ".join('"' + t.replace('"', '""') + '"' for t in terminos)
+    with _db_archivo_lock:
+        return db_archivo().execute(
+            "SELECT a.fecha, a.fuente, a.titulo, a.url FROM busqueda JOIN articulos a ON a.id = busqueda.rowid "
+            "WHERE busqueda MATCH ? ORDER BY rank LIMIT ?",
+            (consulta, limite),
+        ).fetchall()
+
+def urls_archivadas(dia, destinatario=PROPIETARIO):
+    # URLs entregadas ese día a `destinatario`, en su orden
+    with _db_archivo_lock:
+        return [url for (url,) in db_archivo().execute(
+            "SELECT a.url FROM entregas e JOIN articulos a ON a.id = e.articulo "
+            "WHERE e.dia = ? AND e.destinatario = ? ORDER BY e.orden",
+            (dia, destinatario),
+        )]
+
+def articulo_archivado(url):
+    with _db_archivo_lock:
+        con = db_archivo()
+        fila = con.execute("SELECT id, titulo, texto FROM articulos WHERE url = ?", (url,)).fetchone()
+        if fila is None:
+            return None
+        imagenes = [datos for (datos,) in con.execute(
+            "SELECT datos FROM imagenes WHERE articulo = ? ORDER BY orden", (fila[0],)
+        )]
+    return {"titulo": fila[1], "texto": zlib.decompress(fila[2]).decode("utf-8"), "imagenes": imagenes}
+
+def reconstruir_edicion(dia, destinatario=PROPIETARIO):
+    # EPUB de lo que recibió `destinatario` ese día, desde el archivo y sin red;
+    # None si no hay nada archivado. Cada llamada escribe su propio archivo (dos
+    # /resend simultáneos no se pisan) y quien la llama lo borra tras enviarlo.
+    urls = urls_archivadas(dia, destinatario)
+    if not urls:
+        return None
+    os.makedirs(EDITION_CACHE_DIR, exist_ok=True)
+    fd, ruta = tempfile.mkstemp(dir=EDITION_CACHE_DIR, prefix=f"archivo_{dia}.", suffix=".epub")
+    os.close(fd)
+    try:
+        articulos = ((i, url, articulo_archivado(url)) for i, url in enumerate(urls))
+        escribir_epub(articulos, ruta, datetime.strptime(dia, "%Y%m%d"), recargar=articulo_archivado)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(ruta)
+        raise
+    return ruta
 
 # --- Email a Kindle ---
 import aiosmtplib
-async def enviar_email_kindle(file_path, subject, recipient):
-    print(f"[LOG] Enviando email a {recipient} con archivo {file_path}")
+def construir_mensaje_epub(file_path, subject, nombre=None):
+    # El adjunto se codifica una sola vez; la cabecera To se antepone por destinatario
     message = EmailMessage()
     message["From"] = formataddr(("NewsBot", EMAIL_SENDER))
-    message["To"] = recipient
     message["Subject"] = subject
     message.set_content("Archivo generado para tu Kindle.")
-    try:
-        with open(file_path, "rb") as f:
-            file_data = f.read()
-            file_name = os.path.basename(file_path)
-            message.add_attachment(
-                file_data, maintype="application", subtype="epub+zip", filename=file_name
-            )
-    except Exception as e:
-        print(f"[ERROR] No se pudo adjuntar archivo: {e}")
-        return False
-    try:
-        response = await aiosmtplib.send(
-            message,
-            hostname=SMTP_SERVER,
-            port=SMTP_PORT,
-            start_tls=True,
-            username=EMAIL_SENDER,
-            password=EMAIL_PASSWORD,
+    with open(file_path, "rb") as f:
+        message.add_attachment(
+            f.read(), maintype="application", subtype="epub+zip", filename=nombre or os.path.basename(file_path)
         )
-        print(f"[LOG] Email enviado. SMTP: {response}")
+    return message.as_bytes(policy=policy.SMTP)
+
+def error_smtp_transitorio(e):
+    if isinstance(e, (aiosmtplib.SMTPServerDisconnected, aiosmtplib.SMTPConnectError,
+                      aiosmtplib.SMTPTimeoutError, asyncio.TimeoutError, ConnectionError)):
         return True
+    return isinstance(e, aiosmtplib.SMTPResponseException) and 400 <= e.code < 500
+
+async def enviar_epub_a_destinatarios(
+    file_path, subject, recipients, hostname=SMTP_SERVER, port=SMTP_PORT,
+    start_tls=SMTP_STARTTLS, username=EMAIL_SENDER, password=EMAIL_PASSWORD, pool_size=SMTP_POOL_SIZE,
+    nombre=None,
+):
+    # Envía el EPUB a todos los destinatarios reutilizando hasta `pool_size` sesiones SMTP.
+    # Devuelve {destinatario: None si se envió, o la excepción}.
+    print(f"[LOG] Enviando {file_path} a {len(recipients)} destinatarios")
+    try:
+        cuerpo = construir_mensaje_epub(file_path, subject, nombre)
     except Exception as e:
-        print(f"[ERROR] Error enviando email: {e}")
-        return False
+        print(f"[ERROR] No se pudo adjuntar archivo: {e}")
+        return {r: e for r in recipients}
+    cola = asyncio.Queue()
+    for recipient in recipients:
+        cola.put_nowait(recipient)
+    resultados = {}
+
+    async def conectar():
+        smtp = aiosmtplib.SMTP(hostname=hostname, port=port, start_tls=start_tls, timeout=SMTP_TIMEOUT)
+        await smtp.connect()
+        if username:
+            await smtp.login(username, password)
+        return smtp
+
+    async def trabajador():
+        smtp = None
+        try:
+            while not cola.empty():
+                recipient = cola.get_nowait()
+                mensaje = f"To: {recipient}\r\n".encode() + cuerpo
+                for intento in range(SMTP_RETRIES + 1):
+                    try:
+                        if smtp is None or not smtp.is_connected:
+                            smtp = await conectar()
+                        await smtp.sendmail(EMAIL_SENDER, [recipient], mensaje)
+                        print(f"[LOG] Email enviado a {recipient}")
+                        contar("raspinews_emails_total", resultado="enviado")
+                        resultados[recipient] = None
+                        break
+                    except Exception as e:
+                        transitorio = error_smtp_transitorio(e)
+                        if transitorio and smtp is not None:
+                            smtp.close()
+                            smtp = None
+                        if not transitorio or intento == SMTP_RETRIES:
+                            print(f"[ERROR] Error enviando email a {recipient}: {e}")
+                            contar("raspinews_emails_total", resultado="error")
+                            resultados[recipient] = e
+                            break
+                        espera = SMTP_BACKOFF * 2 ** intento
+                        print(f"[LOG] Reintentando {recipient} en {espera:.0f}s: {e}")
+                        contar("raspinews_emails_total", resultado="reintento")
+                        await asyncio.sleep(espera)
+        finally:
+            if smtp is not None and smtp.is_connected:
+                try:
+                    await smtp.quit()
+                except Exception:
+                    smtp.close()
+
+    await asyncio.gather(*(trabajador() for _ in range(max(1, min(pool_size, len(recipients))))))
+    return resultados
 
 # --- Protección de comandos ---
 def only_owner(func):
@@ -324,6 +1509,9 @@ async def remove_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     emails = [e for e in emails if e != email]
     guardar_emails(emails)
+    suscripciones = cargar_suscripciones()
+    if suscripciones.pop(email, None) is not None:
+        guardar_suscripciones(suscripciones)
     await update.message.reply_text(f"Correo {email} eliminado.")
 
 @only_owner
@@ -372,7 +1560,109 @@ async def list_emails(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not emails:
         await update.message.reply_text("No hay correos registrados.")
     else:
-        await update.message.reply_text("Correos registrados:\n" + "\n".join(emails))
+        suscripciones = cargar_suscripciones()
+        lineas = []
+        for email in emails:
+            propias = len(suscripcion(suscripciones, email)["fuentes"])
+            lineas.append(f"{email} ({propias} fuentes propias)" if propias else email)
+        await update.message.reply_text("Correos registrados:\n" + "\n".join(lineas))
+
+# --- Comandos de suscripción ---
+async def suscripcion_de_comando(update, context, minimo, uso):
+    # Valida "/comando correo ..." y devuelve (email, suscripciones) o (None, None)
+    if len(context.args) < minimo:
+        await update.message.reply_text(f"Uso: {uso}")
+        return None, None
+    email = context.args[0]
+    if email not in cargar_emails():
+        await update.message.reply_text("Ese correo no está registrado.")
+        return None, None
+    return email, cargar_suscripciones()
+
+@only_owner
+async def sub_add_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    email, suscripciones = await suscripcion_de_comando(
+        update, context, 3, "/subaddsource correo@ejemplo.com Nombre URL_RSS"
+    )
+    if email is None:
+        return
+    name, url = context.args[1], context.args[2]
+    datos = suscripcion(suscripciones, email)
+    if any(f["rss"] == url for f in datos["fuentes"]):
+        await update.message.reply_text("Esa fuente ya está en la suscripción.")
+        return
+    datos["fuentes"].append({"name": name, "rss": url})
+    suscripciones[email] = datos
+    guardar_suscripciones(suscripciones)
+    await update.message.reply_text(f"Fuente {name} agregada a la suscripción de {email}.")
+
+@only_owner
+async def sub_remove_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    email, suscripciones = await suscripcion_de_comando(
+        update, context, 2, "/subremovesource correo@ejemplo.com NombreFuente"
+    )
+    if email is None:
+        return
+    name = context.args[1]
+    datos = suscripcion(suscripciones, email)
+    fuentes = [f for f in datos["fuentes"] if f["name"].lower() != name.lower()]
+    if len(fuentes) == len(datos["fuentes"]):
+        await update.message.reply_text("No se encontró esa fuente en la suscripción.")
+        return
+    datos["fuentes"] = fuentes
+    suscripciones[email] = datos
+    guardar_suscripciones(suscripciones)
+    aviso = "" if fuentes else " Sin fuentes propias, recibirá las fuentes generales."
+    await update.message.reply_text(f"Fuente '{name}' eliminada de la suscripción de {email}.{aviso}")
+
+@only_owner
+async def sub_banword(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    email, suscripciones = await suscripcion_de_comando(
+        update, context, 2, "/subbanword correo@ejemplo.com palabra_o_frase"
+    )
+    if email is None:
+        return
+    palabra = " ".join(context.args[1:]).strip().lower()
+    datos = suscripcion(suscripciones, email)
+    if palabra in datos["banwords"]:
+        await update.message.reply_text(f"'{palabra}' ya está bloqueada para {email}.")
+        return
+    datos["banwords"].append(palabra)
+    suscripciones[email] = datos
+    guardar_suscripciones(suscripciones)
+    await update.message.reply_text(f"'{palabra}' bloqueada para {email}.")
+
+@only_owner
+async def sub_unbanword(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    email, suscripciones = await suscripcion_de_comando(
+        update, context, 2, "/subunbanword correo@ejemplo.com palabra_o_frase"
+    )
+    if email is None:
+        return
+    palabra = " ".join(context.args[1:]).strip().lower()
+    datos = suscripcion(suscripciones, email)
+    if palabra not in datos["banwords"]:
+        await update.message.reply_text(f"'{palabra}' no está bloqueada para {email}.")
+        return
+    datos["banwords"] = [w for w in datos["banwords"] if w != palabra]
+    suscripciones[email] = datos
+    guardar_suscripciones(suscripciones)
+    await update.message.reply_text(f"'{palabra}' desbloqueada para {email}.")
+
+@only_owner
+async def subscription(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    email, suscripciones = await suscripcion_de_comando(update, context, 1, "/subscription correo@ejemplo.com")
+    if email is None:
+        return
+    datos = suscripcion(suscripciones, email)
+    lineas = [f"Suscripción de {email}:"]
+    if datos["fuentes"]:
+        lineas += [f"- {f['name']}: {f['rss']}" for f in datos["fuentes"]]
+    else:
+        lineas.append("- Fuentes generales")
+    if datos["banwords"]:
+        lineas.append("Bloqueadas: " + ", ".join(datos["banwords"]))
+    await update.message.reply_text("\n".join(lineas))
 
 @only_owner
 async def add_source(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -394,14 +1684,36 @@ async def list_sources(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not fuentes:
         await update.message.reply_text("No hay fuentes registradas.")
     else:
-        msg = "Fuentes:\n" + "\n".join([f"{f['name']}: {f['rss']}" for f in fuentes])
+        salud = cargar_salud()
+        msg = "Fuentes:\n" + "\n".join(
+            [f"{f['name']}: {f['rss']}\n   {resumen_salud(salud.get(f['rss'], {}))}" for f in fuentes]
+        )
         await update.message.reply_text(msg)
 
 @only_owner
 async def generate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Generando y enviando EPUB...")
-    await tarea_diaria(context.application)
-    await update.message.reply_text("¡Envío terminado!")
+    try:
+        envios = await lanzar_edicion(context.application, True, update.effective_chat.id)
+    except EdicionCancelada:
+        await update.message.reply_text("Edición cancelada.")
+        return
+    except Exception as e:
+        await update.message.reply_text(f"❌ Error: {e}")
+        return
+    if envios is None:
+        await update.message.reply_text("No hay noticias nuevas.")
+    else:
+        await update.message.reply_text("¡Envío terminado!\n" + resumen_envios(envios))
+
+@only_owner
+async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    trabajo = trabajo_en_curso()
+    if trabajo is None:
+        await update.message.reply_text("No hay ninguna edición en curso.")
+        return
+    _cancelacion.set()
+    await update.message.reply_text(f"Cancelando (etapa actual: {trabajo.etapa}); se detiene al terminar el paso en curso.")
 
 @only_owner
 async def update_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -423,79 +1735,627 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     status_lines.append(f"- EMAIL_SENDER: {EMAIL_SENDER}")
     status_lines.append(f"- SMTP_SERVER: {SMTP_SERVER}:{SMTP_PORT}")
     status_lines.append(f"- Correos registrados: {len(cargar_emails())}")
-    status_lines.append(f"- Fuentes: {len(cargar_fuentes())}")
-    status_lines.append(f"- Noticias enviadas: {len(cargar_enviadas())}")
+    fuentes = cargar_fuentes()
+    salud = cargar_salud()
+    ahora = time.time()
+    con_fallos = [f["name"] for f in fuentes if salud.get(f["rss"], {}).get("fallos_seguidos")]
+    en_pausa = [f["name"] for f in fuentes if circuito_abierto(salud.get(f["rss"], {}), ahora)]
+    status_lines.append(f"- Fuentes: {len(fuentes)} ({len(con_fallos)} con fallos, {len(en_pausa)} en pausa)")
+    if con_fallos:
+        status_lines.append(f"- Fallando: {', '.join(con_fallos)}")
+    status_lines.append(f"- Noticias enviadas: {contar_enviadas()}")
+    status_lines.extend(f"- {linea}" for linea in reporte_importaciones())
+    status_lines.append(
+        f"- Caché de artículos: {estadisticas_cache['aciertos']} aciertos, {estadisticas_cache['fallos']} fallos"
+    )
+    trabajo = trabajo_en_curso()
+    if trabajo is not None:
+        status_lines.append(
+            f"- Edición en curso: {trabajo.etapa} ({time.monotonic() - trabajo.inicio:.0f}s)"
+        )
+    if ultimo_ajuste_epub:
+        status_lines.append(
+            f"- Última edición: {ultimo_ajuste_epub['bytes'] / 1024:.0f} KB, "
+            f"imágenes hasta {ultimo_ajuste_epub['lado']}px calidad {ultimo_ajuste_epub['calidad']}"
+        )
     await update.message.reply_text("\n".join(status_lines))
 
-# --- Lógica de obtención y envío de noticias ---
-async def tarea_diaria(application):
-    print("[LOG] Ejecutando tarea diaria...")
-    fuentes = cargar_fuentes()
-    enviadas = cargar_enviadas()
-    nuevas_urls = []
-    for fuente in fuentes:
+@only_owner
+async def metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    texto = resumen_metricas()
+    for bloque in agrupar_notificaciones(texto.split("\n")):
+        await update.message.reply_text(bloque)
+
+# --- Salud de las fuentes ---
+# Por cada feed (clave: URL) se guardan las últimas latencias de descargas
+# completas (200; un 304 no trae cuerpo y bajaría el p95) y la racha de
+# fallos. El timeout de cada consulta sale de su p95 reciente, y tras
+# SOURCE_BREAKER_FAILURES fallos seguidos la fuente se omite (circuito abierto)
+# durante una pausa que se duplica con cada nuevo fallo; al vencer se prueba una vez.
+SALUD_MUESTRAS = 20
+
+def cargar_salud():
+    try:
+        return leer_estado(SOURCE_HEALTH_FILE, decodificar_json, {})
+    except Exception as e:
+        print(f"[ERROR] Cargando salud de fuentes: {e}")
+        return {}
+
+def guardar_salud(salud):
+    escribir_estado(SOURCE_HEALTH_FILE, salud, codificar_json)
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(p / 100 * len(ordenados)))]
+
+def timeout_adaptativo(registro):
+    # Con historial suficiente: 3 veces el p95, entre FEED_TIMEOUT_MIN y FEED_TIMEOUT
+    latencias = registro.get("latencias_200", [])
+    if len(latencias) < 5:
+        return FEED_TIMEOUT
+    return min(FEED_TIMEOUT, max(FEED_TIMEOUT_MIN, 3 * percentil(latencias, 95)))
+
+def circuito_abierto(registro, ahora):
+    return registro.get("pausa_hasta", 0) > ahora
+
+def actualizar_salud(registro, fuente, estado, segundos, error):
+    ahora = time.time()
+    registro["consultas"] = registro.get("consultas", 0) + 1
+    if estado != "error":
+        if estado != "304":
+            registro["latencias_200"] = (registro.get("latencias_200", []) + [round(segundos, 3)])[-SALUD_MUESTRAS:]
+        registro["fallos_seguidos"] = 0
+        registro["ultimo_ok"] = ahora
+        registro.pop("pausa_hasta", None)
+        return
+    registro["fallos"] = registro.get("fallos", 0) + 1
+    registro["fallos_seguidos"] = racha = registro.get("fallos_seguidos", 0) + 1
+    registro["ultimo_error"] = (error or "")[:200]
+    if racha >= SOURCE_BREAKER_FAILURES:
+        pausa = min(SOURCE_BREAKER_MINUTES * 2 ** (racha - SOURCE_BREAKER_FAILURES), 24 * 60)
+        registro["pausa_hasta"] = ahora + pausa * 60
+        contar("raspinews_circuitos_abiertos_total", fuente=fuente["name"])
+        notificar(f"Fuente {fuente['name']} en pausa {pausa:g} min tras {racha} fallos seguidos: {registro['ultimo_error']}")
+
+def resumen_salud(registro):
+    if not registro:
+        return "sin datos"
+    if circuito_abierto(registro, time.time()):
+        hasta = datetime.fromtimestamp(registro["pausa_hasta"]).strftime("%d/%m %H:%M")
+        return f"en pausa hasta {hasta} ({registro['fallos_seguidos']} fallos: {registro.get('ultimo_error', '')[:80]})"
+    partes = []
+    latencias = registro.get("latencias_200", [])
+    if latencias:
+        partes.append(f"p50 {percentil(latencias, 50):.2f}s, p95 {percentil(latencias, 95):.2f}s")
+    if registro.get("fallos_seguidos"):
+        partes.append(f"{registro['fallos_seguidos']} fallos seguidos")
+    partes.append(f"{registro.get('fallos', 0)}/{registro.get('consultas', 0)} errores")
+    return ", ".join(partes)
+
+# --- Obtención concurrente de feeds ---
+# La precarga y una edición pueden consultar feeds a la vez: cada una guarda
+# sólo sus propios cambios sobre el estado releído bajo este lock.
+_feeds_lock = threading.Lock()
+
+def cargar_cache_feeds():
+    try:
+        return leer_estado(FEED_CACHE_FILE, decodificar_json, {})
+    except Exception as e:
+        print(f"[ERROR] Cargando caché de feeds: {e}")
+        return {}
+
+def guardar_cache_feeds(cache):
+    escribir_estado(FEED_CACHE_FILE, cache, lambda datos: json.dumps(datos, ensure_ascii=False).encode("utf-8"))
+
+class LecturaConCopia:
+    # Envuelve el flujo de la respuesta guardando lo leído, para poder
+    # pasárselo completo a feedparser si la lectura incremental falla
+    def __init__(self, crudo):
+        self.crudo = crudo
+        self.leido = bytearray()
+
+    def read(self, n=-1):
+        datos = self.crudo.read(n)
+        self.leido += datos
+        return datos
+
+def entrada_xml(elem, etree):
+    entrada = {"link": "", "title": "", "summary": "", "content": "", "guid": ""}
+    for hijo in elem:
+        if not isinstance(hijo.tag, str):
+            continue
+        nombre = etree.QName(hijo).localname
+        texto = "".join(hijo.itertext()).strip()
+        if nombre == "title":
+            entrada["title"] = texto
+        elif nombre == "link":
+            # RSS: <link>url</link>; Atom: <link rel="alternate" href="url"/>
+            if hijo.get("href") is not None:
+                if hijo.get("rel", "alternate") == "alternate" and not entrada["link"]:
+                    entrada["link"] = hijo.get("href")
+            elif texto:
+                entrada["link"] = texto
+        elif nombre in ("guid", "id"):
+            entrada["guid"] = texto
+        elif nombre in ("description", "summary") and not entrada["summary"]:
+            entrada["summary"] = texto
+        elif nombre in ("encoded", "content") and not entrada["content"]:
+            # RSS content:encoded y Atom <content>; en Atom type="xhtml" el HTML viene como nodos
+            if len(hijo):
+                texto = "".join(etree.tostring(nodo, encoding="unicode") for nodo in hijo)
+            entrada["content"] = texto
+    return entrada if entrada["link"] else None
+
+def leer_entradas_incremental(flujo, seguidores):
+    # Feeds más recientes primero: al llegar a una entrada que ya recibieron todos
+    # los `seguidores` del feed se deja de leer, sin descargar ni construir el resto
+    etree = modulo("lxml.etree")
+    entradas = []
+    # Sin recover: ante entidades HTML u otros errores se lanza la excepción
+    # y descargar_feed recurre a feedparser, que es más tolerante
+    for _, elem in etree.iterparse(flujo, events=("end",)):
+        if not isinstance(elem.tag, str) or etree.QName(elem).localname not in ("item", "entry"):
+            continue
+        entrada = entrada_xml(elem, etree)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+        if entrada is None:
+            continue
+        if ya_enviada(seguidores, entrada["link"], entrada["guid"]):
+            return entradas, True
+        entradas.append(entrada)
+    return entradas, False
+
+def descargar_feed(fuente, previo, timeout=FEED_TIMEOUT, seguidores=()):
+    # GET condicional: con un 304 se reutilizan las entradas guardadas. Si lo
+    # guardado se cortó antes de que alguien empezara a seguir el feed, le faltan
+    # entradas que ese seguidor no ha recibido y se pide el feed completo.
+    seguidores = sorted(set(seguidores))
+    headers = {}
+    if not previo.get("cortado") or set(seguidores) <= set(previo.get("seguidores", [])):
+        if previo.get("etag"):
+            headers["If-None-Match"] = previo["etag"]
+        if previo.get("modified"):
+            headers["If-Modified-Since"] = previo["modified"]
+    with abrir_url(fuente["rss"], FEED_MAX_BYTES, TIPOS_FEED, headers, timeout, timeout) as (resp, limitado):
+        if resp.status_code == 304:
+            return previo, "304"
+        resp.raise_for_status()
+        flujo = LecturaConCopia(limitado)
+        entradas, cortado = None, False
+        if FEED_EARLY_STOP and seguidores:
+            try:
+                entradas, cortado = leer_entradas_incremental(flujo, seguidores)
+            except Exception as e:
+                print(f"[LOG] Feed {fuente['name']}: lectura incremental falló ({e}), usando feedparser")
+        if not entradas and not cortado:
+            flujo.read()
+            feed = modulo("feedparser").parse(bytes(flujo.leido), response_headers=dict(resp.headers))
+            entradas = [
+                {
+                    "link": e.link, "title": e.get("title", ""), "summary": e.get("summary", ""),
+                    "content": (e.get("content") or [{}])[0].get("value", ""), "guid": e.get("id", ""),
+                }
+                for e in feed.entries if e.get("link")
+            ]
+        elif cortado:
+            print(f"[LOG] Feed {fuente['name']}: corte tras {len(entradas)} entradas nuevas")
+        contar("raspinews_bytes_descargados_total", len(flujo.leido), tipo="feed")
+    nuevo = {
+        "etag": resp.headers.get("ETag"),
+        "modified": resp.headers.get("Last-Modified"),
+        "entries": entradas,
+        "cortado": cortado,
+        "seguidores": seguidores,
+    }
+    return nuevo, str(resp.status_code)
+
+def obtener_feeds(fuentes, seguidores=None):
+    # Consulta todas las fuentes en paralelo; devuelve los resultados en el orden de las fuentes.
+    # seguidores: {rss: destinatarios que siguen el feed}; sin ellos no se corta la lectura.
+    seguidores = seguidores or {}
+    cache = cargar_cache_feeds()
+    salud = cargar_salud()
+    ahora = time.time()
+
+    def consultar(fuente):
+        registro = salud.get(fuente["rss"], {})
+        previo = cache.get(fuente["rss"], {})
+        if circuito_abierto(registro, ahora):
+            return previo, "omitida", 0.0, None
+        inicio = time.monotonic()
         try:
-            feed = feedparser.parse(fuente["rss"])
-            for entry in feed.entries:
-                url = entry.link
-                if url not in enviadas:
-                    nuevas_urls.append(url)
+            datos, estado = descargar_feed(
+                fuente, previo, timeout_adaptativo(registro), seguidores.get(fuente["rss"], ())
+            )
+            error = None
         except Exception as e:
             print(f"[ERROR] Fuente {fuente['name']}: {e}")
-    if not nuevas_urls:
-        print("No hay noticias nuevas.")
-        return
-    nuevas_urls = nuevas_urls[:10]
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".epub") as tmp_epub:
-        tmp_epub.close()
-        crear_epub_con_noticias(nuevas_urls, tmp_epub.name)
-        emails = cargar_emails()
-        for email in emails:
-            await enviar_email_kindle(tmp_epub.name, "Noticias Diarias", email)
-        try:
-            await application.bot.send_document(
-                chat_id=int(CHAT_ID),
-                document=open(tmp_epub.name, "rb"),
-                filename=f"noticias_{datetime.now().strftime('%Y%m%d')}.epub",
+            datos, estado, error = previo, "error", str(e)
+        return datos, estado, time.monotonic() - inicio, error
+
+    inicio_total = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, min(FEED_WORKERS, len(fuentes)))) as pool:
+        respuestas = list(pool.map(consultar, fuentes))
+    resultados = []
+    with _feeds_lock:
+        # Releer: otra consulta pudo guardar ETags o rachas de fallos mientras tanto
+        cache = cargar_cache_feeds()
+        salud = cargar_salud()
+        for fuente, (datos, estado, segundos, error) in zip(fuentes, respuestas):
+            print(f"[LOG] Feed {fuente['name']}: {estado} en {segundos:.2f}s")
+            contar("raspinews_feeds_total", fuente=fuente["name"], estado=estado)
+            if estado != "omitida":
+                observar("raspinews_feed_segundos", segundos, fuente=fuente["name"])
+                actualizar_salud(salud.setdefault(fuente["rss"], {}), fuente, estado, segundos, error)
+            if estado not in ("error", "omitida", "304"):
+                # Con un 304 no se toca: la otra consulta pudo dejar una versión más nueva
+                cache[fuente["rss"]] = datos
+            resultados.append({
+                "fuente": fuente,
+                "entradas": datos.get("entries", []) if estado not in ("error", "omitida") else [],
+                "estado": estado,
+                "segundos": segundos,
+            })
+        guardar_cache_feeds(cache)
+        guardar_salud(salud)
+    print(f"[LOG] {len(fuentes)} feeds consultados en {time.monotonic() - inicio_total:.2f}s")
+    return resultados
+
+# --- Detección de noticias casi duplicadas ---
+# Cada noticia se reduce al conjunto de palabras de su título + resumen
+# (normalizadas, sin palabras vacías) y dos noticias son la misma si su
+# similitud de Jaccard alcanza DUPLICATE_SIMILARITY. Calibrado con pares reales
+# entre fuentes (tests/test_duplicados.py): la misma nota de agencia reescrita
+# por otro medio queda entre 0.55 y 0.97; notas distintas del mismo tema, en 0.40 o menos.
+PALABRAS_VACIAS = frozenset("""
+    de del la las el los lo en y e o u a al un una unos unas que se su sus por para con sin
+    sobre entre como mas pero este esta estos estas ese esa eso le les ha han fue ser es son
+    era tras ante desde hasta the of and or to in on at by for with from as is are was were
+    be been has have had its it this that an after over into
+""".split())
+RASGOS_MINIMOS = 6
+
+def rasgos_noticia(texto):
+    palabras = {
+        p for p in re.findall(r"\w+", normalizar_texto(texto)) if p not in PALABRAS_VACIAS
+    }
+    if len(palabras) < RASGOS_MINIMOS:
+        # Demasiado corto para comparar sin falsos positivos
+        return None
+    return frozenset(
+        int.from_bytes(hashlib.blake2b(p.encode("utf-8"), digest_size=4).digest(), "big") for p in palabras
+    )
+
+def similitud_jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+def texto_plano(html):
+    return re.sub(r"<[^>]+>", " ", html or "")
+
+def sin_duplicados(entradas, destinatario=PROPIETARIO):
+    # Genera (entrada, rasgos) saltando las que se parecen al menos DUPLICATE_SIMILARITY
+    # a una ya elegida o a una enviada a `destinatario` en los últimos DUPLICATE_DAYS días
+    vistas = rasgos_recientes(destinatario)
+    for entrada in entradas:
+        rasgos = rasgos_noticia(f"{entrada.get('title', '')} {texto_plano(entrada.get('summary'))}")
+        if rasgos is not None:
+            if any(similitud_jaccard(rasgos, otros) >= DUPLICATE_SIMILARITY for otros in vistas):
+                print(f"[LOG] Duplicada descartada: {entrada.get('title') or entrada['link']}")
+                contar("raspinews_duplicadas_total")
+                continue
+            vistas.append(rasgos)
+        yield entrada, rasgos
+
+# --- Lógica de obtención y envío de noticias ---
+def no_bloqueada(entry, banwords=()):
+    bloqueo = regla_bloqueo(entry, banwords)
+    if bloqueo:
+        print(f"[LOG] Bloqueada por '{bloqueo[0]}' ({bloqueo[1]}): {entry.get('title') or entry['link']}")
+        return False
+    return True
+
+def seleccionar_noticias(resultados, limite=EDITION_MAX_ARTICLES, banwords=(), destinatario=PROPIETARIO):
+    # Primeras noticias no enviadas a `destinatario`, bloqueadas ni duplicadas, en el
+    # orden de las fuentes. Cada una es la entrada del feed con "fuente" y "rasgos" añadidos.
+    candidatas = (
+        dict(entry, fuente=resultado["fuente"]["name"])
+        for resultado in resultados
+        for entry in resultado["entradas"]
+        if not ya_enviada([destinatario], entry["link"], entry.get("guid")) and no_bloqueada(entry, banwords)
+    )
+    nuevas = []
+    for entrada, rasgos in sin_duplicados(candidatas, destinatario):
+        entrada["rasgos"] = rasgos
+        nuevas.append(entrada)
+        if len(nuevas) >= limite:
+            break
+    return nuevas
+
+# --- Ediciones por suscriptor ---
+# Cada feed distinto se consulta una vez por ciclo aunque lo sigan varios
+# suscriptores; los destinatarios con la misma selección comparten edición y
+# cada artículo se descarga una sola vez (queda en la caché de artículos).
+def planificar_ciclo(origen, limite=EDITION_MAX_ARTICLES):
+    # Lista de ediciones {"noticias", "emails", "propietario"}; la del propietario
+    # (enviada por Telegram) usa las fuentes y palabras bloqueadas generales
+    generales = cargar_fuentes()
+    suscripciones = cargar_suscripciones()
+    destinos = [(PROPIETARIO, generales, [])]
+    for email in cargar_emails():
+        datos = suscripcion(suscripciones, email)
+        destinos.append((email, datos["fuentes"] or generales, datos["banwords"]))
+    distintas = {}
+    seguidores = {}
+    for destinatario, fuentes, _ in destinos:
+        for fuente in fuentes:
+            distintas.setdefault(fuente["rss"], fuente)
+            seguidores.setdefault(fuente["rss"], []).append(destinatario)
+    with medir("feeds", origen=origen):
+        por_rss = {r["fuente"]["rss"]: r for r in obtener_feeds(list(distintas.values()), seguidores)}
+    ediciones = {}
+    with medir("seleccion", origen=origen):
+        for email, fuentes, banwords in destinos:
+            nuevas = seleccionar_noticias([por_rss[f["rss"]] for f in fuentes], limite, banwords, email)
+            if not nuevas:
+                continue
+            edicion = ediciones.setdefault(
+                tuple(n["link"] for n in nuevas), {"noticias": nuevas, "emails": [], "propietario": False}
             )
+            if email == PROPIETARIO:
+                edicion["propietario"] = True
+            else:
+                edicion["emails"].append(email)
+    return list(ediciones.values())
+
+def entradas_de(ediciones):
+    # {url: entrada del feed} de todas las ediciones, en orden y sin repetir
+    return {n["link"]: n for edicion in ediciones for n in edicion["noticias"]}
+
+def urls_de(ediciones):
+    return list(entradas_de(ediciones))
+
+def construir_ediciones(ediciones):
+    # Agrega "ruta" a cada edición. Con varias ediciones por construir, primero
+    # se descargan todos los artículos distintos y luego se arman los EPUB en paralelo.
+    pendientes = [
+        e for e in ediciones
+        if not os.path.exists(ruta_edicion(clave_edicion([n["link"] for n in e["noticias"]])))
+    ]
+    if len(pendientes) > 1:
+        for _ in descargar_articulos(urls_de(pendientes), entradas_de(pendientes)):
+            pass
+    with ThreadPoolExecutor(max_workers=max(1, min(EDITION_WORKERS, len(ediciones)))) as pool:
+        rutas = pool.map(lambda e: obtener_edicion(urls_de([e]), entradas_de([e])), ediciones)
+        for edicion, ruta in zip(ediciones, rutas):
+            edicion["ruta"] = ruta
+    return ediciones
+
+async def enviar_ediciones(ediciones, nombre):
+    # Envía cada edición a sus correos; devuelve {email: None o excepción}
+    envios = await asyncio.gather(*(
+        enviar_epub_a_destinatarios(e["ruta"], "Noticias Diarias", e["emails"], nombre=nombre)
+        for e in ediciones if e["emails"]
+    ))
+    return {email: error for resultado in envios for email, error in resultado.items()}
+
+def destinatarios_entregados(edicion, envios):
+    # Correos que aceptaron la edición, más el propietario si recibió su copia por Telegram
+    entregados = [email for email in edicion["emails"] if email in envios and envios[email] is None]
+    if edicion.get("telegram"):
+        entregados.append(PROPIETARIO)
+    return entregados
+
+def precargar_noticias():
+    # Consulta los feeds y deja en caché los artículos e imágenes que
+    # probablemente entren en las próximas ediciones
+    entradas = entradas_de(planificar_ciclo("precarga", PREFETCH_ARTICLES))
+    urls = list(entradas)
+    listas = sum(1 for _, _, articulo in descargar_articulos(urls, entradas) if articulo is not None)
+    print(f"[LOG] Precarga: {listas}/{len(urls)} artículos en caché")
+
+async def tarea_precarga(application):
+    try:
+        await asyncio.to_thread(precargar_noticias)
+    except Exception as e:
+        print(f"[ERROR] Precarga: {e}")
+
+# --- Trabajos de edición ---
+# Una sola edición en curso a la vez: /generate, /force y el cron que lleguen
+# mientras se construye esperan ese mismo trabajo. El trabajo pesado corre en
+# hilos (asyncio.to_thread) para que el bot siga respondiendo. La cancelación es
+# cooperativa: se revisa entre etapas y después de cada artículo descargado.
+class EdicionCancelada(Exception):
+    pass
+
+_cancelacion = threading.Event()
+_trabajo_actual = None
+
+def verificar_cancelacion():
+    if _cancelacion.is_set():
+        raise EdicionCancelada("Edición cancelada")
+
+class TrabajoEdicion:
+    def __init__(self, application, registrar):
+        # registrar: marcar como enviadas y mandar la copia del propietario (edición diaria)
+        self.application = application
+        self.registrar = registrar
+        self.chats = set()
+        self.etapa = "iniciando"
+        self.inicio = time.monotonic()
+        self.tarea = asyncio.create_task(self._ejecutar())
+
+    async def avisar(self, texto):
+        self.etapa = texto
+        print(f"[LOG] Edición: {texto}")
+        for chat_id in list(self.chats):
+            try:
+                await self.application.bot.send_message(chat_id=chat_id, text=texto)
+            except Exception as e:
+                print(f"[ERROR] Enviando progreso: {e}")
+
+    async def _ejecutar(self):
+        # Devuelve {email: None o excepción}, o None si no hay noticias nuevas
+        _cancelacion.clear()
+        try:
+            return await self._construir_y_enviar()
+        finally:
+            _cancelacion.clear()
+
+    async def _construir_y_enviar(self):
+        origen = "diaria" if self.registrar else "force"
+        await self.avisar("Consultando feeds...")
+        ediciones = await asyncio.to_thread(planificar_ciclo, origen)
+        if not ediciones:
+            print("No hay noticias nuevas.")
+            return None
+        verificar_cancelacion()
+        await self.avisar(f"Construyendo {len(ediciones)} ediciones con {len(urls_de(ediciones))} artículos...")
+        with medir("epub", origen=origen):
+            await asyncio.to_thread(construir_ediciones, ediciones)
+        verificar_cancelacion()
+        nombre_epub = f"noticias_{datetime.now().strftime('%Y%m%d')}.epub"
+        await self.avisar(f"Enviando a {sum(len(e['emails']) for e in ediciones)} correos...")
+        with medir("smtp", origen=origen):
+            envios = await enviar_ediciones(ediciones, nombre_epub)
+        # Se lee al final: un /generate que se une a un /force en curso lo activa
+        if self.registrar:
+            for edicion in ediciones:
+                if not edicion["propietario"]:
+                    continue
+                try:
+                    with medir("telegram", origen=origen):
+                        with open(edicion["ruta"], "rb") as documento:
+                            await self.application.bot.send_document(
+                                chat_id=int(CHAT_ID), document=documento, filename=nombre_epub,
+                            )
+                    edicion["telegram"] = True
+                except Exception as e:
+                    print(f"[ERROR] Enviando EPUB a Telegram: {e}")
+            # Sólo a quien la recibió: un correo que falló vuelve a tener esas noticias en la siguiente
+            for edicion in ediciones:
+                await asyncio.to_thread(
+                    registrar_enviadas, edicion["noticias"], destinatarios_entregados(edicion, envios)
+                )
+        # También con /force: /resend reconstruye lo que recibió cada destinatario
+        try:
+            archivados = 0
+            for edicion in ediciones:
+                archivados += await asyncio.to_thread(
+                    archivar_entregas, edicion["noticias"], destinatarios_entregados(edicion, envios)
+                )
+            print(f"[LOG] Archivo: {archivados} artículos nuevos")
         except Exception as e:
-            print(f"[ERROR] Enviando EPUB a Telegram: {e}")
-        os.unlink(tmp_epub.name)
-    enviadas.update(nuevas_urls)
-    guardar_enviadas(enviadas)
+            print(f"[ERROR] Archivando artículos: {e}")
+        # Se poda con todo entregado: antes podría borrar una edición que aún espera su correo
+        await asyncio.to_thread(podar_cache, EDITION_CACHE_DIR, EDITION_CACHE_TTL, EDITION_CACHE_MAX_BYTES)
+        print(f"[LOG] Edición terminada en {time.monotonic() - self.inicio:.1f}s")
+        return envios
+
+def trabajo_en_curso():
+    if _trabajo_actual is not None and not _trabajo_actual.tarea.done():
+        return _trabajo_actual
+    return None
+
+async def lanzar_edicion(application, registrar, chat_id=None):
+    # Inicia una edición o se une a la que está en curso, y espera su resultado
+    global _trabajo_actual
+    trabajo = trabajo_en_curso()
+    if trabajo is None:
+        trabajo = _trabajo_actual = TrabajoEdicion(application, registrar)
+    else:
+        print("[LOG] Edición ya en curso, esperando su resultado")
+        trabajo.registrar = trabajo.registrar or registrar
+    if chat_id is not None:
+        trabajo.chats.add(chat_id)
+    # shield: si un llamador se cancela, el trabajo compartido sigue
+    return await asyncio.shield(trabajo.tarea)
+
+def resumen_envios(envios):
+    lineas = []
+    for email, error in envios.items():
+        if error is None:
+            lineas.append(f"✅ Email sent to {email}")
+        else:
+            lineas.append(f"❌ Error sending to {email}: {error}")
+    return "\n".join(lineas) or "Sin correos registrados."
+
+async def tarea_diaria(application):
+    print("[LOG] Ejecutando tarea diaria...")
+    try:
+        await lanzar_edicion(application, registrar=True)
+    except EdicionCancelada:
+        print("[LOG] Edición diaria cancelada")
+    except Exception as e:
+        print(f"[ERROR] Edición diaria: {e}")
+        notificar(f"Error en la edición diaria: {e}")
 
 BANWORDS_FILE = "banwords.json"
 
 def cargar_banwords():
-    if not os.path.exists(BANWORDS_FILE):
+    try:
+        return leer_estado(BANWORDS_FILE, decodificar_json, [])
+    except Exception as e:
+        print(f"[ERROR] Cargando banwords: {e}")
         return []
-    with open(BANWORDS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
 
 def guardar_banwords(banwords):
-    with open(BANWORDS_FILE, "w", encoding="utf-8") as f:
-        json.dump(banwords, f, ensure_ascii=False, indent=2)
+    escribir_estado(BANWORDS_FILE, banwords, codificar_json)
+    invalidar_matcher_banwords()
 
-def obtener_noticias_nuevas():
-    # Carga fuentes y noticias enviadas
-    fuentes = cargar_fuentes()
-    enviadas = cargar_enviadas()
-    nuevas_urls = []
-    palabras_bloqueo = ["sociales", "espectáculos", "espectaculos", "farandula", "farándula", "show", "celebridad", "celebridades", "gente"]
-    palabras_bloqueo += cargar_banwords()
-    for fuente in fuentes:
-        url = fuente["rss"]
-        feed = feedparser.parse(url)
-        for entry in feed.entries:
-            link = entry.link
-            titulo = getattr(entry, 'title', '').lower()
-            resumen = getattr(entry, 'summary', '').lower()
-            url_lower = link.lower()
-            if any(pal.lower() in titulo or pal.lower() in resumen or pal.lower() in url_lower for pal in palabras_bloqueo):
-                continue
-            if link not in enviadas and link not in nuevas_urls:
-                nuevas_urls.append(link)
-    return nuevas_urls
+# --- Filtro de palabras bloqueadas ---
+PALABRAS_BLOQUEO = ["sociales", "espectáculos", "espectaculos", "farandula", "farándula", "show", "celebridad", "celebridades", "gente"]
+# Una sola regex con todas las palabras normalizadas; se reconstruye sólo
+# cuando cambia banwords.json (por mtime o al guardar desde /banword y /unbanword)
+_matcher_banwords = {"firma": None, "regex": None, "reglas": {}}
+_matcher_lock = threading.Lock()
+
+def normalizar_texto(texto):
+    # Minúsculas y sin acentos: "Farándula" -> "farandula"
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+def invalidar_matcher_banwords():
+    with _matcher_lock:
+        _matcher_banwords["firma"] = None
+
+def matcher_banwords():
+    try:
+        firma = os.stat(BANWORDS_FILE).st_mtime_ns
+    except OSError:
+        firma = 0
+    with _matcher_lock:
+        if _matcher_banwords["firma"] != firma:
+            regex, reglas = compilar_palabras(tuple(PALABRAS_BLOQUEO + cargar_banwords()))
+            _matcher_banwords["regex"] = regex
+            _matcher_banwords["reglas"] = reglas
+            _matcher_banwords["firma"] = firma
+        return _matcher_banwords["regex"], _matcher_banwords["reglas"]
+
+@functools.lru_cache(maxsize=64)
+def compilar_palabras(palabras):
+    # (regex, {normalizada: original}) para una tupla de palabras; se reutiliza
+    # entre suscriptores con la misma lista
+    reglas = {}
+    for palabra in palabras:
+        normalizada = normalizar_texto(palabra).strip()
+        if normalizada:
+            reglas.setdefault(normalizada, palabra)
+    patron = "|".join(re.escape(p) for p in sorted(reglas, key=len, reverse=True))
+    return (re.compile(patron) if patron else None), reglas
+
+def regla_bloqueo(entry, extra=()):
+    # Devuelve (regla, campo) de la primera palabra bloqueada encontrada, o None.
+    # `extra` son las palabras propias de un suscriptor.
+    for regex, reglas in (matcher_banwords(), compilar_palabras(tuple(extra))):
+        if regex is None:
+            continue
+        for campo in ("title", "summary", "link"):
+            encontrada = regex.search(normalizar_texto(entry.get(campo) or ""))
+            if encontrada:
+                return reglas[encontrada.group(0)], campo
+    return None
 
 @only_owner
 async def banword(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -525,6 +2385,56 @@ async def unbanword(update: Update, context: ContextTypes.DEFAULT_TYPE):
     guardar_banwords(banwords)
     await update.message.reply_text(f"'{palabra}' eliminada de la lista de palabras/frases baneadas.")
 
+@only_owner
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        await update.message.reply_text("Uso: /search palabras")
+        return
+    try:
+        filas = await asyncio.to_thread(buscar_archivo, context.args)
+    except sqlite3.Error as e:
+        await update.message.reply_text(f"Búsqueda inválida: {e}")
+        return
+    if not filas:
+        await update.message.reply_text("Sin resultados en el archivo.")
+        return
+    lineas = [
+        f"{datetime.fromtimestamp(fecha).strftime('%Y%m%d')} · {fuente or '-'} · {titulo}\n{url}"
+        for fecha, fuente, titulo, url in filas
+    ]
+    await update.message.reply_text("\n\n".join(lineas)[:4096])
+
+@only_owner
+async def resend(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(context.args) not in (1, 2) or not re.fullmatch(r"\d{8}", context.args[0]):
+        await update.message.reply_text("Uso: /resend AAAAMMDD [correo@ejemplo.com]")
+        return
+    dia = context.args[0]
+    destino = context.args[1] if len(context.args) == 2 else None
+    if destino is not None and destino not in cargar_emails():
+        await update.message.reply_text("Ese correo no está registrado.")
+        return
+    try:
+        datetime.strptime(dia, "%Y%m%d")
+        # Sin correo, la edición del propietario
+        ruta = await asyncio.to_thread(reconstruir_edicion, dia, destino or PROPIETARIO)
+    except Exception as e:
+        await update.message.reply_text(f"❌ Error: {e}")
+        return
+    if ruta is None:
+        await update.message.reply_text(f"No hay artículos archivados del {dia}" + (f" para {destino}." if destino else "."))
+        return
+    nombre_epub = f"noticias_{dia}.epub"
+    try:
+        if destino is None:
+            with open(ruta, "rb") as documento:
+                await context.bot.send_document(chat_id=update.effective_chat.id, document=documento, filename=nombre_epub)
+            return
+        envios = await enviar_epub_a_destinatarios(ruta, f"Noticias {dia}", [destino], nombre=nombre_epub)
+        await update.message.reply_text(resumen_envios(envios))
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(ruta)
 
 # --- Bot Telegram y scheduler ---
 @only_owner
@@ -532,33 +2442,14 @@ async def force_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message:
         await update.message.reply_text("Fetching and sending today's news...")
     try:
-        # Obtener emails y noticias nuevas igual que en tarea_diaria
-        emails = cargar_emails()
-        nuevas_urls = obtener_noticias_nuevas()
-        if not nuevas_urls:
+        # Mismas ediciones que en tarea_diaria, sin marcar las noticias como enviadas
+        envios = await lanzar_edicion(context.application, False, update.effective_chat.id)
+        if not envios:
             await update.message.reply_text("No new news to send.")
             return
-        nuevas_urls = nuevas_urls[:10]
-        from shutil import copyfile
-        from datetime import datetime
-        fecha_str = datetime.now().strftime("%Y%m%d")
-        nombre_epub = f"RaspiNews_Mexico_{fecha_str}.epub"
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".epub") as tmp_epub:
-            tmp_epub.close()
-            crear_epub_con_noticias(nuevas_urls, tmp_epub.name)
-            # Copiar a nombre seguro
-            ruta_epub_final = os.path.join(os.path.dirname(tmp_epub.name), nombre_epub)
-            copyfile(tmp_epub.name, ruta_epub_final)
-            results = []
-            for email in emails:
-                try:
-                    await enviar_email_kindle(ruta_epub_final, "Noticias Diarias", email)
-                    results.append(f"✅ Email sent to {email}")
-                except Exception as e:
-                    results.append(f"❌ Error sending to {email}: {e}")
-            os.unlink(tmp_epub.name)
-            os.unlink(ruta_epub_final)
-        await update.message.reply_text("\n".join(results))
+        await update.message.reply_text(resumen_envios(envios))
+    except EdicionCancelada:
+        await update.message.reply_text("Edición cancelada.")
     except Exception as e:
         await update.message.reply_text(f"❌ Error: {e}")
 
@@ -570,9 +2461,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/listemails — Lista correos\n"
         "/addsource Nombre URL_RSS — Agrega fuente\n"
         "/listsources — Lista fuentes\n"
+        "/subaddsource correo Nombre URL_RSS — Fuente propia de un correo\n"
+        "/subremovesource correo Nombre — Quita fuente propia\n"
+        "/subbanword correo palabra — Bloquea palabra para un correo\n"
+        "/subunbanword correo palabra — Desbloquea palabra\n"
+        "/subscription correo — Muestra la suscripción\n"
         "/generate — Genera y envía manualmente\n"
+        "/cancel — Cancela la edición en curso\n"
         "/update — Actualiza desde GitHub\n"
-        "/status — Estado general"
+        "/status — Estado general\n"
+        "/metrics — Tiempos y contadores del pipeline\n"
+        "/search palabras — Busca en los artículos enviados\n"
+        "/resend AAAAMMDD [correo] — Reconstruye desde el archivo la edición que recibió ese día el correo (o tú)"
     )
 
 async def log_all_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -581,8 +2481,45 @@ async def log_all_updates(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if str(user_id) == str(CHAT_ID):
         await update.message.reply_text("Mensaje recibido.")
 
+async def iniciar_servicios(app):
+    # Se ejecuta dentro del event loop del bot: los trabajos corren en ese mismo loop
+    app.bot_data["notificador"] = asyncio.create_task(despachar_notificaciones(app))
+    if METRICS_PORT:
+        app.bot_data["servidor_metricas"] = iniciar_servidor_metricas()
+    hora, minuto = (int(x) for x in EDITION_TIME.split(":"))
+    scheduler = modulo("apscheduler.schedulers.asyncio").AsyncIOScheduler()
+    scheduler.add_job(tarea_diaria, "cron", hour=hora, minute=minuto, args=[app])
+    if PREFETCH_MINUTES > 0:
+        # La primera precarga llega tras un intervalo completo: un reinicio
+        # (p. ej. /update) no dispara feeds, descargas ni imports pesados
+        scheduler.add_job(
+            tarea_precarga, "interval", minutes=PREFETCH_MINUTES, args=[app],
+            next_run_time=datetime.now() + timedelta(minutes=PREFETCH_MINUTES), coalesce=True,
+        )
+    scheduler.start()
+    app.bot_data["scheduler"] = scheduler
+    print(f"[LOG] Edición diaria a las {EDITION_TIME}, precarga cada {PREFETCH_MINUTES:g} min")
+
+async def detener_servicios(app):
+    scheduler = app.bot_data.get("scheduler")
+    if scheduler is not None:
+        scheduler.shutdown(wait=False)
+    notificador = app.bot_data.get("notificador")
+    if notificador is not None:
+        notificador.cancel()
+    servidor_metricas = app.bot_data.get("servidor_metricas")
+    if servidor_metricas is not None:
+        servidor_metricas.shutdown()
+    cerrar_pool_imagenes()
+
 def main():
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(iniciar_servicios)
+        .post_shutdown(detener_servicios)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("addemail", add_email))
@@ -591,16 +2528,27 @@ def main():
     app.add_handler(CommandHandler("addsource", add_source))
     app.add_handler(CommandHandler("removesource", remove_source))
     app.add_handler(CommandHandler("listsources", list_sources))
-    app.add_handler(CommandHandler("generate", generate))
+    app.add_handler(CommandHandler("subaddsource", sub_add_source))
+    app.add_handler(CommandHandler("subremovesource", sub_remove_source))
+    app.add_handler(CommandHandler("subbanword", sub_banword))
+    app.add_handler(CommandHandler("subunbanword", sub_unbanword))
+    app.add_handler(CommandHandler("subscription", subscription))
+    # block=False: la edición corre como tarea y el bot sigue atendiendo comandos
+    app.add_handler(CommandHandler("generate", generate, block=False))
+    app.add_handler(CommandHandler("cancel", cancel))
     app.add_handler(CommandHandler("update", update_bot))
     app.add_handler(CommandHandler("status", status))
-    app.add_handler(CommandHandler("force", force_send))
+    app.add_handler(CommandHandler("metrics", metrics))
+    app.add_handler(CommandHandler("force", force_send, block=False))
     app.add_handler(CommandHandler("banword", banword))
     app.add_handler(CommandHandler("unbanword", unbanword))
+    app.add_handler(CommandHandler("search", search))
+    # Reconstruye el EPUB y envía por SMTP con reintentos: no debe frenar al bot
+    app.add_handler(CommandHandler("resend", resend, block=False))
     app.add_handler(MessageHandler(filters.ALL, log_all_updates))
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(tarea_diaria, "cron", hour=7, minute=0, args=[app])
-    scheduler.start()
+    tiempos_arranque["listo"] = time.perf_counter() - _inicio_arranque
+    for linea in reporte_importaciones():
+        print(f"[LOG] {linea}")
     print("[LOG] Iniciando bot...")
     app.run_polling()
     print("[LOG] Bot detenido.")
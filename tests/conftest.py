@@ -0,0 +1,22 @@
+import os
+import socket
+import sys
+
+import pytest
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# bot_script exige estas variables al importarse
+os.environ.setdefault("TELEGRAM_TOKEN", "0:pruebas")
+os.environ.setdefault("TELEGRAM_USER_ID", "0")
+os.environ.setdefault("EMAIL_ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("EMAIL_SENDER", "bot@example.com")
+os.environ.setdefault("EMAIL_PASSWORD", "-")
+
+
+@pytest.fixture
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
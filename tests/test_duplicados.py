@@ -0,0 +1,113 @@
+import bot_script as bot
+
+# Pares (título, resumen, título, resumen) con la forma en que llegan de feeds
+# reales: la misma nota en dos medios, y notas distintas sobre el mismo tema.
+DUPLICADAS = [
+    # una palabra cambiada
+    ("Wildfire forces thousands to evacuate in southern California",
+     "Officials ordered more than 12,000 residents to leave their homes on Tuesday as a fast-moving wildfire spread across dry hills east of San Diego, fire officials said.",
+     "Wildfire forces thousands to evacuate in southern California",
+     "Authorities ordered more than 12,000 residents to leave their homes on Tuesday as a fast-moving wildfire spread across dry hills east of San Diego, fire officials said."),
+    # sufijo del sitio en el título
+    ("Bank of England holds interest rates at 5.25%",
+     "The Bank of England has kept interest rates unchanged for a third time in a row, as inflation continues to fall faster than expected.",
+     "Bank of England holds interest rates at 5.25% - BBC News",
+     "The Bank of England has kept interest rates unchanged for a third time in a row, as inflation continues to fall faster than expected."),
+    # nota de agencia reescrita ligeramente
+    ("Magnitude 7.1 earthquake strikes off the coast of Japan, tsunami warning issued",
+     "A powerful magnitude 7.1 earthquake struck off Japan's southwestern coast on Thursday, the Japan Meteorological Agency said, prompting a tsunami warning for parts of Kyushu and Shikoku.",
+     "Strong 7.1 quake hits southwestern Japan, tsunami advisory issued",
+     "A strong earthquake of magnitude 7.1 hit off the southwestern coast of Japan on Thursday, the Japan Meteorological Agency said, issuing a tsunami advisory for Kyushu and Shikoku."),
+    ("Banxico recorta su tasa de interés a 10.75%",
+     "El Banco de México redujo este jueves su tasa de interés de referencia en 25 puntos base, a 10.75%, en una decisión dividida de su Junta de Gobierno ante la desaceleración de la inflación.",
+     "Banco de México baja la tasa de interés a 10.75 por ciento",
+     "La Junta de Gobierno del Banco de México recortó este jueves en 25 puntos base la tasa de interés de referencia, que queda en 10.75%, en una decisión dividida ante la desaceleración de la inflación."),
+    ("Senado aprueba en lo general la reforma al Poder Judicial",
+     "Con 86 votos a favor y 41 en contra, el pleno del Senado aprobó en lo general la reforma al Poder Judicial enviada por el Ejecutivo, que contempla la elección de jueces por voto popular.",
+     "Aprueba Senado en lo general reforma judicial; jueces serán electos por voto popular | Milenio",
+     "El pleno del Senado aprobó en lo general, con 86 votos a favor y 41 en contra, la reforma al Poder Judicial enviada por el Ejecutivo, que prevé que jueces sean electos por voto popular."),
+    # resumen recortado en una fuente
+    ("Huracán Otis toca tierra en Acapulco como categoría 5",
+     "El huracán Otis tocó tierra la madrugada de este miércoles cerca de Acapulco, Guerrero, como categoría 5 con vientos sostenidos de 270 kilómetros por hora, informó el Servicio Meteorológico Nacional.",
+     "Huracán Otis toca tierra en Acapulco como categoría 5",
+     "El huracán Otis tocó tierra la madrugada de este miércoles cerca de Acapulco, Guerrero, como categoría 5 con vientos sostenidos de 270 kilómetros..."),
+    ("Apple unveils iPhone 16 with new camera button and AI features",
+     "Apple on Monday introduced the iPhone 16 lineup, adding a dedicated camera control button and its Apple Intelligence features, with prices starting at $799.",
+     "Apple launches iPhone 16, adds camera button and Apple Intelligence",
+     "Apple introduced its iPhone 16 lineup on Monday with a dedicated camera control button and Apple Intelligence AI features; prices start at $799."),
+    ("Pemex reporta pérdida de 273 mil millones de pesos en el segundo trimestre",
+     "Petróleos Mexicanos reportó una pérdida neta de 273 mil millones de pesos entre abril y junio, afectada por la depreciación del peso y menores ventas, informó la empresa a la Bolsa Mexicana de Valores.",
+     "Pemex pierde 273 mil mdp en el segundo trimestre por depreciación del peso",
+     "Petróleos Mexicanos (Pemex) registró una pérdida neta de 273 mil millones de pesos en el segundo trimestre, afectada por la depreciación del peso y menores ventas, según su reporte a la Bolsa Mexicana de Valores."),
+]
+
+DISTINTAS = [
+    ("Magnitude 7.1 earthquake strikes off the coast of Japan, tsunami warning issued",
+     "A powerful magnitude 7.1 earthquake struck off Japan's southwestern coast on Thursday, the Japan Meteorological Agency said, prompting a tsunami warning for parts of Kyushu and Shikoku.",
+     "Magnitude 6.4 earthquake shakes southern Taiwan, no tsunami threat",
+     "A magnitude 6.4 earthquake struck southern Taiwan on Sunday, the Central Weather Administration said, damaging buildings in Tainan but posing no tsunami threat."),
+    ("Bank of England holds interest rates at 5.25%",
+     "The Bank of England has kept interest rates unchanged for a third time in a row, as inflation continues to fall faster than expected.",
+     "US Federal Reserve cuts interest rates by half a point",
+     "The Federal Reserve cut interest rates for the first time in four years on Wednesday, lowering its benchmark rate by half a percentage point as inflation eases."),
+    ("Banxico recorta su tasa de interés a 10.75%",
+     "El Banco de México redujo este jueves su tasa de interés de referencia en 25 puntos base, a 10.75%, en una decisión dividida de su Junta de Gobierno ante la desaceleración de la inflación.",
+     "Inflación en México baja a 4.6% en la primera quincena de septiembre",
+     "La inflación general en México se ubicó en 4.6% anual en la primera quincena de septiembre, su menor nivel desde febrero, informó el Instituto Nacional de Estadística y Geografía."),
+    ("Senado aprueba en lo general la reforma al Poder Judicial",
+     "Con 86 votos a favor y 41 en contra, el pleno del Senado aprobó en lo general la reforma al Poder Judicial enviada por el Ejecutivo, que contempla la elección de jueces por voto popular.",
+     "Trabajadores del Poder Judicial mantienen paro nacional contra la reforma",
+     "Empleados del Poder Judicial de la Federación anunciaron que mantendrán el paro nacional de labores en protesta contra la reforma judicial, mientras el Senado discute la iniciativa."),
+    ("Huracán Otis toca tierra en Acapulco como categoría 5",
+     "El huracán Otis tocó tierra la madrugada de este miércoles cerca de Acapulco, Guerrero, como categoría 5 con vientos sostenidos de 270 kilómetros por hora, informó el Servicio Meteorológico Nacional.",
+     "Suben a 48 los muertos por el huracán Otis en Guerrero",
+     "La cifra de muertos por el paso del huracán Otis en Guerrero aumentó a 48, mientras continúan las labores de rescate y la entrega de víveres en Acapulco, informó el gobierno federal."),
+    ("Apple unveils iPhone 16 with new camera button and AI features",
+     "Apple on Monday introduced the iPhone 16 lineup, adding a dedicated camera control button and its Apple Intelligence features, with prices starting at $799.",
+     "Samsung unveils Galaxy S25 with new AI features",
+     "Samsung on Wednesday introduced the Galaxy S25 lineup, adding new Galaxy AI features and a faster chip, with prices starting at $799."),
+    ("Wildfire forces thousands to evacuate in southern California",
+     "Officials ordered more than 12,000 residents to leave their homes on Tuesday as a fast-moving wildfire spread across dry hills east of San Diego, fire officials said.",
+     "Wildfire near Los Angeles destroys dozens of homes",
+     "A wildfire fueled by strong Santa Ana winds destroyed dozens of homes in the hills north of Los Angeles on Wednesday, fire officials said, as crews struggled to contain it."),
+    ("Pemex reporta pérdida de 273 mil millones de pesos en el segundo trimestre",
+     "Petróleos Mexicanos reportó una pérdida neta de 273 mil millones de pesos entre abril y junio, afectada por la depreciación del peso y menores ventas, informó la empresa a la Bolsa Mexicana de Valores.",
+     "CFE acumula pérdidas en el primer semestre por el alza en combustibles",
+     "La Comisión Federal de Electricidad perdió 44 mil millones de pesos en el segundo trimestre; la empresa atribuyó el resultado al encarecimiento del gas natural y a costos financieros por el tipo de cambio."),
+]
+
+
+def similitud(par):
+    titulo1, resumen1, titulo2, resumen2 = par
+    return bot.similitud_jaccard(
+        bot.rasgos_noticia(f"{titulo1} {resumen1}"), bot.rasgos_noticia(f"{titulo2} {resumen2}")
+    )
+
+
+def test_detecta_la_misma_nota_en_otro_medio():
+    for par in DUPLICADAS:
+        assert similitud(par) >= bot.DUPLICATE_SIMILARITY, par[2]
+
+
+def test_no_confunde_notas_distintas_del_mismo_tema():
+    for par in DISTINTAS:
+        assert similitud(par) < bot.DUPLICATE_SIMILARITY, par[2]
+
+
+def test_descarta_duplicadas_del_ciclo_y_de_dias_anteriores(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "_db_enviadas", None)
+    titulo1, resumen1, titulo2, resumen2 = DUPLICADAS[2]
+    otra = DISTINTAS[2]
+    entradas = [
+        {"link": "https://a.example/1", "title": titulo1, "summary": resumen1, "fuente": "A"},
+        {"link": "https://b.example/1", "title": titulo2, "summary": resumen2, "fuente": "B"},
+        {"link": "https://b.example/2", "title": otra[2], "summary": otra[3], "fuente": "B"},
+    ]
+    elegidas = []
+    for entrada, rasgos in bot.sin_duplicados(entradas):
+        elegidas.append(dict(entrada, rasgos=rasgos))
+    assert [e["link"] for e in elegidas] == ["https://a.example/1", "https://b.example/2"]
+    # Al día siguiente la versión de B ya no pasa: la de A quedó registrada
+    bot.registrar_enviadas(elegidas[:1], [bot.PROPIETARIO])
+    assert [e["link"] for e, _ in bot.sin_duplicados(entradas[1:])] == ["https://b.example/2"]
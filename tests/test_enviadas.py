@@ -0,0 +1,40 @@
+import io
+
+import pytest
+
+pytest.importorskip("lxml")
+
+import bot_script as bot
+
+FEED = b"""<rss><channel>
+<item><guid>tag:3</guid><link>https://a.example/3</link><title>Tres</title></item>
+<item><guid>tag:2</guid><link>https://a.example/2</link><title>Dos</title></item>
+<item><guid>tag:1</guid><link>https://a.example/1</link><title>Uno</title></item>
+</channel></rss>"""
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(bot, "_db_enviadas", None)
+
+
+def noticia(n):
+    return {"link": f"https://a.example/{n}", "guid": f"tag:{n}", "fuente": "A", "rasgos": None}
+
+
+def test_lo_enviado_a_un_destinatario_no_se_oculta_a_otro(db):
+    bot.registrar_enviadas([noticia(1)], [bot.PROPIETARIO])
+    assert bot.ya_enviada([bot.PROPIETARIO], "https://a.example/1")
+    assert not bot.ya_enviada(["b@example.com"], "https://a.example/1")
+    assert not bot.ya_enviada([bot.PROPIETARIO, "b@example.com"], "https://a.example/1")
+    # El guid reconoce la entrada aunque cambie el enlace
+    assert bot.ya_enviada([bot.PROPIETARIO], "https://a.example/1?utm=x", "tag:1")
+
+
+def test_la_lectura_se_corta_cuando_todos_los_seguidores_la_recibieron(db):
+    bot.registrar_enviadas([noticia(2), noticia(1)], [bot.PROPIETARIO])
+    bot.registrar_enviadas([noticia(1)], ["b@example.com"])
+    entradas, cortado = bot.leer_entradas_incremental(io.BytesIO(FEED), [bot.PROPIETARIO, "b@example.com"])
+    assert cortado
+    assert [e["link"] for e in entradas] == ["https://a.example/3", "https://a.example/2"]
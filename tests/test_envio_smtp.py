@@ -0,0 +1,43 @@
+import asyncio
+import collections
+
+import pytest
+
+Controller = pytest.importorskip("aiosmtpd.controller").Controller
+
+import bot_script as bot
+
+
+class SumideroInestable:
+    # Rechaza con 451 los primeros `rechazos` DATA y acepta el resto
+    def __init__(self, rechazos):
+        self.rechazos = rechazos
+        self.recibidos = collections.Counter()
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.rechazos:
+            self.rechazos -= 1
+            return "451 4.3.0 Try again later"
+        for destinatario in envelope.rcpt_tos:
+            self.recibidos[destinatario] += 1
+        return "250 OK"
+
+
+def test_reintenta_tras_451_y_entrega_una_copia(tmp_path, monkeypatch, puerto_libre):
+    monkeypatch.setattr(bot, "SMTP_BACKOFF", 0.01)
+    epub = tmp_path / "edicion.epub"
+    epub.write_bytes(b"PK\x03\x04 edicion de prueba")
+    destinatarios = [f"lector{n}@example.com" for n in range(3)]
+    sumidero = SumideroInestable(rechazos=1)
+    controlador = Controller(sumidero, hostname="127.0.0.1", port=puerto_libre)
+    controlador.start()
+    try:
+        resultados = asyncio.run(bot.enviar_epub_a_destinatarios(
+            str(epub), "Prueba", destinatarios,
+            hostname="127.0.0.1", port=puerto_libre, start_tls=False, username=None, pool_size=2,
+        ))
+    finally:
+        controlador.stop()
+    assert sumidero.rechazos == 0
+    assert resultados == {d: None for d in destinatarios}
+    assert sumidero.recibidos == {d: 1 for d in destinatarios}